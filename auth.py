@@ -0,0 +1,269 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from instrumentation import instrumentation
+from models import db, User
+
+
+# What Flask-Login keeps as current_user. It carries only the columns needed
+# to authorise a request; any other attribute (addresses, orders, status...)
+# loads the full User row once per request and is read from that.
+class SessionUser:
+    __slots__ = ('id', 'username', 'is_admin', 'active')
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, username, is_admin, active):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'username', username)
+        object.__setattr__(self, 'is_admin', bool(is_admin))
+        object.__setattr__(self, 'active', bool(active))
+
+    @property
+    def is_active(self):
+        return self.active
+
+    def get_id(self):
+        return str(self.id)
+
+    @property
+    def record(self):
+        records = g.setdefault('user_records', {})
+        if self.id not in records:
+            records[self.id] = db.session.get(User, self.id)
+        return records[self.id]
+
+    def __getattr__(self, name):
+        # Dunder probes (copy, pickle, Jinja's __html__ check) must not hit the DB
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.record, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.record, name, value)
+
+    def __eq__(self, other):
+        return isinstance(other, (SessionUser, User)) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'<SessionUser {self.id} {self.username!r}>'
+
+
+# Per-process LRU of principals; expired entries are dropped when looked up
+# and the oldest are evicted once max_entries is reached.
+class UserCache:
+    def __init__(self):
+        self.ttl = 300
+        self.max_entries = 10000
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_TTL', 300)
+        app.config.setdefault('USER_CACHE_MAX_ENTRIES', 10000)
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.max_entries = app.config['USER_CACHE_MAX_ENTRIES']
+
+    def load(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[user_id]
+
+        self.misses += 1
+        row = (
+            db.session.query(User.id, User.username, User.is_admin, User.active)
+            .filter(User.id == user_id)
+            .first()
+        )
+        if row is None:
+            return None
+        principal = SessionUser(*row)
+        with self._lock:
+            self._entries[user_id] = (principal, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return principal
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+user_cache = UserCache()
+
+
+def load_user(user_id):
+    try:
+        return user_cache.load(int(user_id))
+    except ValueError:
+        return None
+
+
+# A changed or deleted User row drops its cached principal once the change
+# commits; other processes pick it up when their entry's TTL runs out.
+def _mark_user_dirty(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('dirty_users', set()).add(target.id)
+
+
+event.listen(User, 'after_update', _mark_user_dirty)
+event.listen(User, 'after_delete', _mark_user_dirty)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    for user_id in session.info.pop('dirty_users', ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('dirty_users', None)
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _executor_class():
+    # Under gevent's monkey-patching a plain ThreadPoolExecutor runs its work
+    # in greenlets, where bcrypt would block the hub and every open chat
+    # stream with it; gevent's executor keeps the work on native threads
+    try:
+        from gevent import monkey
+    except ImportError:
+        return ThreadPoolExecutor
+    if monkey.is_module_patched('threading'):
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor
+    return ThreadPoolExecutor
+
+
+# bcrypt releases the GIL, so hashing on a small dedicated pool caps how many
+# cores password work can take at once. When the pool and its queue are
+# full a request is refused at once instead of waiting for a slot, so a login
+# flood cannot tie up the workers that render pages. A slot is held until its
+# hash actually finishes, even when the caller gave up waiting.
+class PasswordHasher:
+    def __init__(self):
+        self.bcrypt = None
+        self.rounds = 12
+        self.timeout = 5
+        self._executor = None
+        self._slots = None
+
+    def init_app(self, app, bcrypt):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_CONCURRENCY', 2)
+        app.config.setdefault('PASSWORD_HASH_MAX_PENDING', 16)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5)
+        self.bcrypt = bcrypt
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        executor = _executor_class()
+        self._executor = executor(max_workers=app.config['PASSWORD_HASH_CONCURRENCY'],
+                                  thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_MAX_PENDING'])
+
+    def _run(self, fn, *args):
+        started = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HasherBusy()
+        finally:
+            instrumentation.record('hash', time.perf_counter() - started)
+
+    def hash(self, password):
+        return self._run(self.bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def check(self, pw_hash, password):
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        # bcrypt hashes look like $2b$<cost>$<salt+digest>
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+passwords = PasswordHasher()
+
+
+# Sliding-window counter of login attempts per key (client IP or email).
+class AttemptLimiter:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        # Records an attempt and returns False if the key is over its limit
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.setdefault(key, deque())
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.limit:
+                return False
+            attempts.append(now)
+            if len(self._attempts) > 10000:
+                self._purge(now)
+            return True
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _purge(self, now):
+        for key in [k for k, v in self._attempts.items() if not v or v[-1] <= now - self.window]:
+            del self._attempts[key]
+
+
+class LoginLimiter:
+    def __init__(self):
+        self.by_ip = AttemptLimiter(20, 300)
+        self.by_email = AttemptLimiter(5, 300)
+
+    def init_app(self, app):
+        app.config.setdefault('LOGIN_LIMIT_PER_IP', (20, 300))
+        app.config.setdefault('LOGIN_LIMIT_PER_EMAIL', (5, 300))
+        self.by_ip = AttemptLimiter(*app.config['LOGIN_LIMIT_PER_IP'])
+        self.by_email = AttemptLimiter(*app.config['LOGIN_LIMIT_PER_EMAIL'])
+
+    def allow(self, ip, email):
+        return self.by_ip.hit(ip) and self.by_email.hit(email.lower())
+
+    def succeeded(self, email):
+        self.by_email.reset(email.lower())
+
+
+login_limiter = LoginLimiter()
@@ -0,0 +1,264 @@
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, select
+from datagen import PASSWORD, EMAIL_DOMAIN
+from jobs import jobs
+from models import db, User, Category
+
+SCENARIOS = ('shop', 'dashboard', 'login', 'register')
+# Bigger is better for these; for every other metric smaller is better
+HIGHER_IS_BETTER = ('throughput',)
+
+
+# Queries are counted per thread, so concurrent requests do not mix counts
+_queries = threading.local()
+
+
+def _count_query(*args):
+    _queries.count = getattr(_queries, 'count', 0) + 1
+
+
+def count_queries(app):
+    with app.app_context():
+        engines = list(db.engines.values())
+    reader = app.extensions.get('read_only_engine')
+    if reader is not None:
+        engines.append(reader)
+    for engine in engines:
+        if not event.contains(engine, 'before_cursor_execute', _count_query):
+            event.listen(engine, 'before_cursor_execute', _count_query)
+
+
+def fixtures(app):
+    # Ids the scenarios pick from, read once before the clock starts
+    with app.app_context():
+        users = db.session.scalars(
+            select(User.id).where(User.email.like(f'%@{EMAIL_DOMAIN}'), User.active.is_(True)).limit(1000)).all()
+        admin = db.session.scalars(select(User.id).where(User.is_admin.is_(True)).limit(1)).first()
+        categories = db.session.scalars(select(Category.id).limit(200)).all()
+    if not users or admin is None:
+        raise click.ClickException('No generated users found; run "flask datagen populate" first.')
+    return {'users': users, 'admin': admin, 'categories': categories}
+
+
+# Each scenario prepares the client's session and returns the request to
+# time as (method, path, test client keyword arguments).
+class Scenarios:
+    def __init__(self, client, data, rng):
+        self.client = client
+        self.data = data
+        self.rng = rng
+
+    def _login_as(self, user_id):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+
+    def _logout(self):
+        with self.client.session_transaction() as session:
+            session.clear()
+
+    def _remote(self):
+        # A fresh client address per request keeps the per-IP login limit out of the numbers
+        return {'REMOTE_ADDR': f'10.{self.rng.randrange(256)}.{self.rng.randrange(256)}.{self.rng.randrange(1, 255)}'}
+
+    def shop(self):
+        self._logout()
+        args = self.rng.choice(({}, {'sort': 'price_asc'}, {'sort': 'rating'}, {'min_rating': 4},
+                                {'category': self.rng.choice(self.data['categories'] or [1])}))
+        return 'GET', '/shop_collection', {'query_string': args}
+
+    def dashboard(self):
+        self._login_as(self.data['admin'])
+        return 'GET', '/admin', {}
+
+    def login(self):
+        self._logout()
+        user_id = self.rng.choice(self.data['users'])
+        return 'POST', '/login', {'environ_base': self._remote(), 'data': {
+            'email': f'user{user_id}@{EMAIL_DOMAIN}', 'password': PASSWORD, 'status': 'active'}}
+
+    def register(self):
+        self._logout()
+        name = 'b' + secrets.token_hex(6)
+        return 'POST', '/register', {'environ_base': self._remote(), 'data': {
+            'username': name, 'email': f'{name}@{EMAIL_DOMAIN}', 'password': PASSWORD,
+            'confirm_password': PASSWORD, 'fullname': 'Bench User', 'phone': '+10000000000',
+            'date_of_birth': '1990-01-01', 'gender': 'female'}}
+
+
+def run_requests(app, data, scenarios, count, seed):
+    # Runs `count` requests in this thread: [(scenario, seconds, queries, status)]
+    rng = random.Random(seed)
+    client = app.test_client()
+    runner = Scenarios(client, data, rng)
+    samples = []
+    for _ in range(count):
+        name = rng.choice(scenarios)
+        method, path, kwargs = getattr(runner, name)()
+        _queries.count = 0
+        started = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        elapsed = time.perf_counter() - started
+        samples.append((name, elapsed, _queries.count, response.status_code))
+        response.close()
+    return samples
+
+
+def run_threads(app, data, scenarios, count, concurrency, seed):
+    results = [None] * concurrency
+    share = [count // concurrency + (i < count % concurrency) for i in range(concurrency)]
+
+    def worker(i):
+        results[i] = run_requests(app, data, scenarios, share[i], seed + i)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [sample for result in results for sample in result]
+
+
+def _worker_process(app, data, scenarios, count, concurrency, seed, queue):
+    # Forked children must not reuse the parent's pooled SQLite connections
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    reader = app.extensions.get('read_only_engine')
+    if reader is not None:
+        reader.dispose(close=False)
+    jobs.after_fork()
+    queue.put(run_threads(app, data, scenarios, count, concurrency, seed))
+
+
+def run_processes(app, data, scenarios, count, workers, concurrency, seed):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    share = [count // workers + (i < count % workers) for i in range(workers)]
+    processes = [context.Process(target=_worker_process,
+                                 args=(app, data, scenarios, share[i], concurrency, seed + 1000 * i, queue))
+                 for i in range(workers)]
+    for p in processes:
+        p.start()
+    samples = [sample for _ in processes for sample in queue.get()]
+    for p in processes:
+        p.join()
+    return samples
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def summarize(samples, elapsed):
+    report = {}
+    for name in sorted({sample[0] for sample in samples}):
+        rows = [sample for sample in samples if sample[0] == name]
+        latencies = sorted(seconds * 1000 for _, seconds, _, _ in rows)
+        queries = [count for _, _, count, _ in rows]
+        report[name] = {
+            'requests': len(rows),
+            'errors': sum(1 for *_, status in rows if status >= 400),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'mean_ms': round(sum(latencies) / len(latencies), 2),
+            'queries_per_request': round(sum(queries) / len(queries), 2),
+            'max_queries': max(queries),
+            'throughput': round(len(rows) / elapsed, 1),
+        }
+    return report
+
+
+def compare(report, baseline, tolerance):
+    # [(scenario, metric, baseline, current, change)] for metrics that got worse by more than tolerance
+    regressions = []
+    for name, current in report['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'throughput'):
+            old, new = before.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append((name, metric, old, new, change))
+    return regressions
+
+
+bench_cli = AppGroup('bench', help='Benchmark the app against generated data.')
+
+
+@bench_cli.command('run')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+              help='Repeatable; defaults to all of them.')
+@click.option('--requests', 'count', default=500, show_default=True, help='Requests in total.')
+@click.option('--concurrency', default=1, show_default=True, help='Threads per worker.')
+@click.option('--workers', default=1, show_default=True, help='Forked worker processes, each with its own app.')
+@click.option('--warmup', default=20, show_default=True, help='Untimed requests first.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Write the JSON report here.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='JSON report to compare against.')
+@click.option('--tolerance', default=0.1, show_default=True, help='Allowed fractional regression.')
+def run_command(scenarios, count, concurrency, workers, warmup, seed, output, baseline, tolerance):
+    """Drive the routes through the test client and report latency
+    percentiles, queries per request and throughput."""
+    app = current_app._get_current_object()
+    # Forms are posted directly, without first fetching a CSRF token
+    app.config['WTF_CSRF_ENABLED'] = False
+    scenarios = list(scenarios or SCENARIOS)
+    data = fixtures(app)
+    count_queries(app)
+
+    if warmup:
+        run_requests(app, data, scenarios, warmup, seed - 1)
+    started = time.perf_counter()
+    if workers > 1:
+        samples = run_processes(app, data, scenarios, count, workers, concurrency, seed)
+    else:
+        samples = run_threads(app, data, scenarios, count, concurrency, seed)
+    elapsed = time.perf_counter() - started
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'settings': {'requests': count, 'concurrency': concurrency, 'workers': workers, 'seed': seed,
+                     'scenarios': scenarios, 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'elapsed_s': round(elapsed, 2),
+        'throughput': round(len(samples) / elapsed, 1),
+        'scenarios': summarize(samples, elapsed),
+    }
+
+    click.echo(f"{'scenario':<12}{'reqs':>7}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'queries':>9}{'req/s':>9}")
+    for name, stats in report['scenarios'].items():
+        click.echo(f"{name:<12}{stats['requests']:>7}{stats['errors']:>5}{stats['p50_ms']:>9}{stats['p95_ms']:>9}"
+                   f"{stats['p99_ms']:>9}{stats['queries_per_request']:>9}{stats['throughput']:>9}")
+    click.echo(f"{len(samples)} requests in {report['elapsed_s']}s, {report['throughput']} req/s")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(report, json.load(f), tolerance)
+        for name, metric, old, new, change in regressions:
+            click.echo(f'REGRESSION {name} {metric}: {old} -> {new} ({change:+.0%})', err=True)
+        if regressions:
+            raise SystemExit(1)
+        click.echo(f'No regressions beyond {tolerance:.0%} against {baseline}')
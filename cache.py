@@ -0,0 +1,303 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+_MISSING = object()
+
+
+# In-process backend: a TTL'd LRU kept in a dict per worker process
+class MemoryBackend:
+    shared = False
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Counters are kept apart from the LRU so they are never evicted
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared backend: a single SQLite file that every worker process on the host
+# reads and writes, so one invalidation is seen by all of them.
+class SQLiteBackend:
+    shared = True
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self.evictions = 0
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_entry ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                'expires_at REAL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_entry_accessed_at ON cache_entry (accessed_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_counter (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute('SELECT value, expires_at FROM cache_entry WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None:
+            return _MISSING
+        if row[1] is not None and row[1] <= now:
+            conn.execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+            return _MISSING
+        conn.execute('UPDATE cache_entry SET accessed_at = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache_entry (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl if ttl else None, now),
+        )
+        overflow = conn.execute('SELECT COUNT(*) FROM cache_entry').fetchone()[0] - self.max_entries
+        if overflow > 0:
+            conn.execute(
+                'DELETE FROM cache_entry WHERE key IN '
+                '(SELECT key FROM cache_entry ORDER BY accessed_at LIMIT ?)',
+                (overflow,),
+            )
+            self.evictions += overflow
+
+    def counter(self, key):
+        row = self._connect().execute('SELECT value FROM cache_counter WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, key):
+        conn = self._connect()
+        conn.execute(
+            'INSERT INTO cache_counter (key, value) VALUES (?, 1) '
+            'ON CONFLICT(key) DO UPDATE SET value = value + 1',
+            (key,),
+        )
+        return self.counter(key)
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connect().execute('DELETE FROM cache_entry')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM cache_entry').fetchone()[0]
+
+
+# Read-through cache for catalog data. Keys live under a generation number that
+# is bumped whenever a Product, ProductImage or Category row is written, so an
+# invalidation drops every cached listing at once without scanning keys.
+class CatalogCache:
+    def __init__(self, app=None):
+        self.backend = None
+        self.default_ttl = 300
+        self.stale_ttl = 0
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'invalidations': 0,
+                       'fragment_hits': 0, 'fragment_misses': 0}
+        self._stats_lock = threading.Lock()
+        self._refreshing = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_TYPE', 'memory')
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_STALE_TTL', 60)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 1024)
+        app.config.setdefault('CACHE_SQLITE_PATH', os.path.join(app.instance_path, 'cache.db'))
+
+        cache_type = app.config['CACHE_TYPE']
+        if cache_type == 'memory':
+            self.backend = MemoryBackend(app.config['CACHE_MAX_ENTRIES'])
+        elif cache_type == 'sqlite':
+            os.makedirs(os.path.dirname(app.config['CACHE_SQLITE_PATH']), exist_ok=True)
+            self.backend = SQLiteBackend(app.config['CACHE_SQLITE_PATH'], app.config['CACHE_MAX_ENTRIES'])
+        else:
+            raise ValueError(f'Unknown CACHE_TYPE {cache_type!r}')
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+        self.stale_ttl = app.config['CACHE_STALE_TTL']
+        app.extensions['catalog_cache'] = self
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def generation(self):
+        return self.backend.counter('catalog:generation')
+
+    def key(self, *parts):
+        return ':'.join(['catalog', str(self.generation())] + [str(p) for p in parts])
+
+    def invalidate(self):
+        self.backend.incr('catalog:generation')
+        self.backend.set(self.key('modified_at'), time.time())
+        self._count('invalidations')
+
+    def modified_at(self):
+        # When the current generation began; the first caller records it for
+        # a generation nobody has invalidated in this backend yet
+        key = self.key('modified_at')
+        value = self.backend.get(key)
+        if value is _MISSING:
+            value = time.time()
+            self.backend.set(key, value)
+        return value
+
+    def get_or_set(self, key, loader, ttl=None):
+        # Entries are stored with a fresh-until time and kept for stale_ttl
+        # longer; a stale hit is served immediately while one background
+        # thread reloads it, so hot pages never wait on the database.
+        ttl = self.default_ttl if ttl is None else ttl
+        full_key = self.key(key)
+        entry = self.backend.get(full_key)
+        if entry is not _MISSING:
+            value, fresh_until = entry
+            if fresh_until > time.time():
+                self._count('hits')
+                return value
+            self._count('stale_hits')
+            self._refresh_in_background(full_key, loader, ttl)
+            return value
+
+        self._count('misses')
+        value = loader()
+        self._store(full_key, value, ttl)
+        return value
+
+    def _store(self, full_key, value, ttl):
+        self.backend.set(full_key, (value, time.time() + ttl), ttl + self.stale_ttl)
+
+    def _refresh_in_background(self, full_key, loader, ttl):
+        with self._stats_lock:
+            if full_key in self._refreshing:
+                return
+            self._refreshing.add(full_key)
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    self._store(full_key, loader(), ttl)
+                self._count('refreshes')
+            except Exception:
+                app.logger.exception('Background cache refresh failed for %s', full_key)
+            finally:
+                with self._stats_lock:
+                    self._refreshing.discard(full_key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def fragment(self, key, render, ttl=None):
+        # Rendered markup, keyed by the caller on its content rather than the
+        # generation, so it outlives invalidations. There is no background
+        # refresh: rendering needs the request context.
+        full_key = 'fragment:' + key
+        value = self.backend.get(full_key)
+        if value is not _MISSING:
+            self._count('fragment_hits')
+            return value
+        self._count('fragment_misses')
+        value = render()
+        self.backend.set(full_key, value, self.default_ttl if ttl is None else ttl)
+        return value
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['stale_hits']) / lookups, 4) if lookups else None
+        stats['entries'] = len(self.backend)
+        stats['evictions'] = self.backend.evictions
+        stats['generation'] = self.generation()
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+
+cache = CatalogCache()
+
+
+# Write-triggered invalidation. Mapper events only mark the session; the
+# generation is bumped after commit so a rolled-back write invalidates nothing.
+def _mark_catalog_dirty(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info['catalog_dirty'] = True
+
+
+def register_invalidation(*models):
+    for model in models:
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, name, _mark_catalog_dirty)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    if session.info.pop('catalog_dirty', False) and cache.backend is not None:
+        cache.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('catalog_dirty', None)
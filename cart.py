@@ -0,0 +1,123 @@
+import time
+from flask import session
+from sqlalchemy import insert
+from catalog import first_image_url
+from models import db, Product, Cart, CartItem
+
+MAX_LINES = 50
+MAX_QUANTITY = 99
+
+
+# The working cart lives in the signed session cookie as {product_id: qty},
+# so adding to the cart never touches the database. A logged-in user's cart
+# is copied to Cart/CartItem lazily, at most once per CART_PERSIST_INTERVAL,
+# and merged with their saved cart in one batch when they log in.
+def get_lines():
+    return {int(pid): qty for pid, qty in session.get('cart', {}).items()}
+
+
+def _save_lines(lines):
+    session['cart'] = {str(pid): qty for pid, qty in lines.items()}
+    session['cart_dirty'] = True
+
+
+def add(product_id, quantity=1):
+    lines = get_lines()
+    if product_id not in lines and len(lines) >= MAX_LINES:
+        return False
+    lines[product_id] = min(lines.get(product_id, 0) + quantity, MAX_QUANTITY)
+    _save_lines(lines)
+    return True
+
+
+def set_quantity(product_id, quantity):
+    lines = get_lines()
+    if quantity <= 0:
+        lines.pop(product_id, None)
+    elif product_id in lines:
+        lines[product_id] = min(quantity, MAX_QUANTITY)
+    _save_lines(lines)
+
+
+def clear():
+    # For carts already settled in the database (checked out or saved at logout)
+    session.pop('cart', None)
+    session.pop('cart_dirty', None)
+
+
+def count():
+    return sum(session.get('cart', {}).values())
+
+
+def _cart_id(connection, user_id):
+    cart_id = connection.execute(db.select(Cart.id).where(Cart.user_id == user_id)).scalar()
+    if cart_id is None:
+        cart_id = connection.execute(insert(Cart).values(user_id=user_id)).inserted_primary_key[0]
+    return cart_id
+
+
+def _replace_items(connection, cart_id, lines):
+    connection.execute(CartItem.__table__.delete().where(CartItem.cart_id == cart_id))
+    if lines:
+        connection.execute(insert(CartItem), [
+            {'cart_id': cart_id, 'product_id': pid, 'quantity': qty} for pid, qty in lines.items()
+        ])
+
+
+def persist(user_id):
+    # Replaces the saved cart with the session cart in one transaction
+    with db.engine.begin() as connection:
+        _replace_items(connection, _cart_id(connection, user_id), get_lines())
+    session['cart_dirty'] = False
+    session['cart_saved_at'] = time.time()
+
+
+def persist_if_due(user_id, interval):
+    if session.get('cart_dirty') and time.time() - session.get('cart_saved_at', 0) >= interval:
+        persist(user_id)
+
+
+def save_on_logout(user_id):
+    if session.get('cart_dirty'):
+        persist(user_id)
+    clear()
+
+
+def merge_on_login(user_id):
+    # Saved items and session items are summed per product, then written back
+    # with one delete and one executemany insert.
+    with db.engine.begin() as connection:
+        cart_id = _cart_id(connection, user_id)
+        saved = dict(connection.execute(
+            db.select(CartItem.product_id, db.func.sum(CartItem.quantity))
+            .where(CartItem.cart_id == cart_id)
+            .group_by(CartItem.product_id)
+        ).all())
+        lines = get_lines()
+        if lines:
+            for pid, qty in lines.items():
+                saved[pid] = min(saved.get(pid, 0) + qty, MAX_QUANTITY)
+            _replace_items(connection, cart_id, saved)
+    session['cart'] = {str(pid): qty for pid, qty in list(saved.items())[:MAX_LINES]}
+    session['cart_dirty'] = False
+    session['cart_saved_at'] = time.time()
+
+
+def view():
+    # Every product in the cart comes back from a single IN query
+    lines = get_lines()
+    if not lines:
+        return [], 0.0
+    rows = (
+        db.session.query(Product.id, Product.name, Product.price, Product.discount_price,
+                         Product.stock, first_image_url)
+        .filter(Product.id.in_(lines))
+        .all()
+    )
+    items = []
+    for pid, name, price, discount_price, stock, image_url in rows:
+        unit_price = discount_price if discount_price is not None else price
+        items.append({'product_id': pid, 'name': name, 'quantity': lines[pid], 'unit_price': unit_price,
+                      'line_total': round(unit_price * lines[pid], 2), 'stock': stock, 'image_url': image_url})
+    items.sort(key=lambda item: item['name'])
+    return items, round(sum(item['line_total'] for item in items), 2)
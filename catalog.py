@@ -0,0 +1,189 @@
+import base64
+import json
+import math
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import joinedload, selectinload, contains_eager
+from cache import cache
+from models import db, Product, ProductImage, ProductRating, Category
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+# Sort orders usable by the catalog: (column, direction, tie-breaker). The
+# tie-breaker keeps the keyset unique when many rows share a sort value; the
+# rating sort breaks ties on ProductRating.product_id so it can walk
+# ix_product_rating_average.
+SORTS = {
+    'newest': (Product.created_at, 'desc', Product.id),
+    'price_asc': (Product.price, 'asc', Product.id),
+    'price_desc': (Product.price, 'desc', Product.id),
+    'rating': (ProductRating.average, 'desc', ProductRating.product_id),
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# Correlated subquery for a product's first image, so a page of cards needs no
+# extra query per product.
+first_image_url = (
+    select(ProductImage.image_url)
+    .where(ProductImage.product_id == Product.id)
+    .order_by(ProductImage.id)
+    .limit(1)
+    .correlate(Product)
+    .scalar_subquery()
+)
+
+
+def encode_cursor(sort, value, product_id):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, product_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, value, product_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Malformed cursor.')
+    if cursor_sort != sort or not isinstance(product_id, int):
+        raise InvalidCursor('Cursor does not match the requested sort order.')
+    # The value comes from the client, so it must have the sort column's type
+    try:
+        if sort == 'newest':
+            value = datetime.fromisoformat(value) if value is not None else None
+        elif isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(value)
+    except (ValueError, TypeError):
+        raise InvalidCursor('Malformed cursor.')
+    return value, product_id
+
+
+def parse_filters(args):
+    # Turns request.args into the keyword arguments of fetch_page. Invalid
+    # numbers are ignored rather than rejected, like an unset filter.
+    def number(name, cast):
+        try:
+            return cast(args[name]) if args.get(name) not in (None, '') else None
+        except ValueError:
+            return None
+
+    sort = args.get('sort', 'newest')
+    return {
+        'category_id': number('category', int),
+        'brand': args.get('brand') or None,
+        'min_price': number('min_price', float),
+        'max_price': number('max_price', float),
+        'min_rating': number('min_rating', float),
+        'sort': sort if sort in SORTS else 'newest',
+        'cursor': args.get('cursor') or None,
+        'limit': min(max(number('limit', int) or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE),
+    }
+
+
+def serialize_product(product, image_url):
+    rating = product.rating
+    return {
+        'id': product.id,
+        'name': product.name,
+        'brand': product.brand,
+        'price': product.price,
+        'discount_price': product.discount_price,
+        'stock': product.stock,
+        'category_id': product.category_id,
+        'category': product.category.name if product.category else None,
+        'image_url': image_url,
+        'rating': round(rating.average, 2) if rating and rating.count else None,
+        'rating_count': rating.count if rating else 0,
+        'created_at': product.created_at.isoformat() if product.created_at else None,
+    }
+
+
+def fetch_page(category_id=None, brand=None, min_price=None, max_price=None, min_rating=None,
+               sort='newest', cursor=None, limit=DEFAULT_PAGE_SIZE):
+    sort_column, direction, tiebreak = SORTS[sort]
+
+    # Every product gets its rating row when it is created (ratings.py, the
+    # bulk import and the migration seed), so rating sorts and filters can
+    # inner-join and drive the query from ix_product_rating_average. Other
+    # listings outer-join and start from the product indexes.
+    query = db.session.query(Product, first_image_url)
+    if sort == 'rating' or min_rating is not None:
+        query = query.join(Product.rating)
+    else:
+        query = query.outerjoin(Product.rating)
+    query = query.options(joinedload(Product.category), contains_eager(Product.rating))
+    if category_id is not None:
+        query = query.filter(Product.category_id == category_id)
+    if brand:
+        query = query.filter(Product.brand == brand)
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+    if min_rating is not None:
+        query = query.filter(ProductRating.average >= min_rating, ProductRating.count > 0)
+
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        keyset = tuple_(sort_column, tiebreak)
+        if direction == 'desc':
+            query = query.filter(keyset < tuple_(value, last_id))
+        else:
+            query = query.filter(keyset > tuple_(value, last_id))
+
+    if direction == 'desc':
+        query = query.order_by(sort_column.desc(), tiebreak.desc())
+    else:
+        query = query.order_by(sort_column.asc(), tiebreak.asc())
+
+    # One extra row tells us whether another page exists without a COUNT(*).
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    items = [serialize_product(product, image_url) for product, image_url in rows]
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1][0]
+        value = last.rating.average if sort == 'rating' else getattr(last, sort_column.key)
+        next_cursor = encode_cursor(sort, value, last.id)
+
+    return {'items': items, 'next_cursor': next_cursor}
+
+
+# Cached read paths. Results are plain dicts so they can be shared between
+# requests and stored in any cache backend.
+def cached_page(**filters):
+    key = 'page:' + json.dumps(filters, sort_keys=True)
+    return cache.get_or_set(key, lambda: fetch_page(**filters))
+
+
+def category_choices():
+    def load():
+        return [(c.id, c.name) for c in db.session.query(Category.id, Category.name).order_by(Category.name)]
+    return cache.get_or_set('categories', load)
+
+
+def product_detail(product_id):
+    def load():
+        product = (
+            db.session.query(Product)
+            .options(joinedload(Product.category), joinedload(Product.rating), selectinload(Product.images))
+            .filter(Product.id == product_id)
+            .first()
+        )
+        if product is None:
+            return None
+        detail = serialize_product(product, product.images[0].image_url if product.images else None)
+        detail['description'] = product.description
+        detail['sku'] = product.sku
+        detail['images'] = [image.image_url for image in product.images]
+        detail['rating_histogram'] = product.rating.histogram if product.rating else [0] * 5
+        return detail
+    return cache.get_or_set(f'product:{product_id}', load)
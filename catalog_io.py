@@ -0,0 +1,314 @@
+import csv
+import io
+import json
+import math
+import time
+from datetime import datetime, timezone
+from itertools import islice
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+import images
+import metrics
+from cache import cache
+from models import db, Product, ProductImage, ProductRating, Category
+
+FIELDS = ('sku', 'name', 'description', 'category', 'brand', 'price', 'discount_price', 'stock', 'images')
+FORMATS = ('csv', 'jsonl')
+# Image URLs inside one CSV cell are separated by this
+IMAGE_SEPARATOR = '|'
+MAX_REPORTED_ERRORS = 100
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.images = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def error(self, line, sku, message):
+        # Only the first errors are kept so a bad feed cannot fill memory
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'sku': sku, 'error': message})
+
+    def as_dict(self):
+        return {'rows': self.rows, 'created': self.created, 'updated': self.updated,
+                'images': self.images, 'failed': self.failed, 'errors': self.errors,
+                'seconds': round(self.elapsed, 2),
+                'rows_per_second': round(self.rows / self.elapsed) if self.elapsed else None}
+
+
+def detect_format(filename):
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def open_upload(upload):
+    # Werkzeug spools large uploads to disk; read them as text without copying.
+    # utf-8-sig drops the byte order mark Excel puts in front of CSV exports.
+    return io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+
+
+def read_rows(stream, fmt):
+    # Yields (line_number, row_dict or None, error) from a text stream. Bytes
+    # that are not UTF-8 end the feed with one error instead of failing the
+    # import; the stream is decoded in blocks, so the line is approximate.
+    decode_error = 'not valid UTF-8 near this line; the rest of the file was skipped'
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        try:
+            for row in reader:
+                yield reader.line_num, row, None
+        except UnicodeDecodeError:
+            yield reader.line_num + 1, None, decode_error
+        return
+    line_number = 0
+    try:
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f'invalid JSON: {e}'
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, 'expected a JSON object'
+                continue
+            yield line_number, row, None
+    except UnicodeDecodeError:
+        yield line_number + 1, None, decode_error
+
+
+def _text(row, name, max_length, required=True):
+    value = row.get(name)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f'{name} is required')
+    if len(value) > max_length:
+        raise ValueError(f'{name} is longer than {max_length} characters')
+    return value or None
+
+
+def _number(row, name, cast, required=True):
+    value = row.get(name)
+    if value is None or str(value).strip() == '':
+        if required:
+            raise ValueError(f'{name} is required')
+        return None
+    try:
+        value = cast(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f'{name} must be a number')
+    if not math.isfinite(value):
+        raise ValueError(f'{name} must be a finite number')
+    if value < 0:
+        raise ValueError(f'{name} must not be negative')
+    return value
+
+
+def clean_row(row):
+    # Validates one feed row the way ProductForm validates a single product
+    image_urls = row.get('images') or []
+    if isinstance(image_urls, str):
+        image_urls = image_urls.split(IMAGE_SEPARATOR)
+    image_urls = [str(url).strip() for url in image_urls if url and str(url).strip()]
+    for url in image_urls:
+        if len(url) > 200:
+            raise ValueError('image URLs must be at most 200 characters')
+    return {
+        'sku': _text(row, 'sku', 100),
+        'name': _text(row, 'name', 100),
+        'description': _text(row, 'description', 10000),
+        'category': _text(row, 'category', 100),
+        'brand': _text(row, 'brand', 100, required=False),
+        'price': _number(row, 'price', float),
+        'discount_price': _number(row, 'discount_price', float, required=False),
+        'stock': _number(row, 'stock', int),
+        'images': list(dict.fromkeys(image_urls)),
+    }
+
+
+def _category_ids(connection, names, known):
+    missing = [name for name in names if name not in known]
+    if missing:
+        connection.execute(insert(Category).on_conflict_do_nothing(), [{'name': name} for name in missing])
+        known.update(connection.execute(
+            select(Category.name, Category.id).where(Category.name.in_(missing))).all())
+    return known
+
+
+# Writes one chunk of cleaned rows in the caller's transaction. Products are
+# upserted on sku with one executemany, and the ORM events that Core writes
+# skip (empty rating row, product counter) are applied here by hand.
+# Returns (created, updated, new_image_urls).
+def write_chunk(connection, rows, categories):
+    rows = list({row['sku']: row for row in rows}.values())
+    skus = [row['sku'] for row in rows]
+    _category_ids(connection, {row['category'] for row in rows}, categories)
+
+    existing = set(connection.execute(select(Product.sku).where(Product.sku.in_(skus))).scalars())
+    now = datetime.now(timezone.utc)
+    stmt = insert(Product)
+    connection.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[Product.sku],
+            set_={name: stmt.excluded[name] for name in
+                  ('name', 'description', 'category_id', 'brand', 'price', 'discount_price', 'stock')},
+        ),
+        [{'sku': row['sku'], 'name': row['name'], 'description': row['description'],
+          'category_id': categories[row['category']], 'brand': row['brand'], 'price': row['price'],
+          'discount_price': row['discount_price'], 'stock': row['stock'], 'created_at': now}
+         for row in rows],
+    )
+    ids = dict(connection.execute(select(Product.sku, Product.id).where(Product.sku.in_(skus))).all())
+
+    created = [ids[sku] for sku in skus if sku not in existing]
+    if created:
+        connection.execute(insert(ProductRating).on_conflict_do_nothing(),
+                           [{'product_id': product_id} for product_id in created])
+        metrics.bump_counter(connection, 'total_products', len(created))
+
+    # Images are attached, never duplicated: re-importing a feed is a no-op
+    wanted = {(ids[row['sku']], url) for row in rows for url in row['images']}
+    new_images = []
+    if wanted:
+        attached = set(connection.execute(
+            select(ProductImage.product_id, ProductImage.image_url)
+            .where(ProductImage.product_id.in_({product_id for product_id, _ in wanted}))
+        ).all())
+        new_images = sorted(wanted - attached)
+        if new_images:
+            connection.execute(insert(ProductImage), [
+                {'product_id': product_id, 'image_url': url} for product_id, url in new_images
+            ])
+    return len(created), len(rows) - len(created), [url for _, url in new_images]
+
+
+def import_catalog(stream, fmt, chunk_size=1000, progress=None):
+    # Streams `stream` through validation and writes it chunk_size rows per
+    # transaction, so memory stays flat however large the feed is. A chunk
+    # that fails to write is reported row by row and the import carries on.
+    report = ImportReport()
+    categories = {}
+    rows = read_rows(stream, fmt)
+    try:
+        while True:
+            batch = list(islice(rows, chunk_size))
+            if not batch:
+                break
+            chunk, lines = [], []
+            for line, row, error in batch:
+                report.rows += 1
+                if error is None:
+                    try:
+                        chunk.append(clean_row(row))
+                        lines.append(line)
+                        continue
+                    except ValueError as e:
+                        error = str(e)
+                report.error(line, (row or {}).get('sku'), error)
+            if not chunk:
+                continue
+            try:
+                with db.engine.begin() as connection:
+                    created, updated, image_urls = write_chunk(connection, chunk, categories)
+            except SQLAlchemyError as e:
+                # Category ids learned inside the failed transaction are gone too
+                categories.clear()
+                message = str(e.orig if getattr(e, 'orig', None) else e)
+                for line, row in zip(lines, chunk):
+                    report.error(line, row['sku'], message)
+                continue
+            report.created += created
+            report.updated += updated
+            report.images += len(image_urls)
+            if image_urls:
+                images.schedule_variants(image_urls)
+            if progress is not None:
+                progress(report)
+    finally:
+        report.elapsed = time.perf_counter() - report.started
+        if report.created or report.updated:
+            cache.invalidate()
+    return report
+
+
+class _Echo:
+    # File-like object whose write() hands the line back to csv.writer's caller
+    def write(self, value):
+        return value
+
+
+def export_catalog(fmt, batch_size=1000):
+    # Yields the catalog as CSV or JSONL lines straight off a database cursor
+    image_urls = (
+        select(func.group_concat(ProductImage.image_url, IMAGE_SEPARATOR))
+        .where(ProductImage.product_id == Product.id)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    query = (
+        select(Product.sku, Product.name, Product.description, Category.name, Product.brand,
+               Product.price, Product.discount_price, Product.stock, image_urls)
+        .join(Category, Category.id == Product.category_id)
+        .order_by(Product.id)
+    )
+    writer = csv.writer(_Echo())
+    if fmt == 'csv':
+        yield writer.writerow(FIELDS)
+    with db.engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(query)
+        for row in result:
+            if fmt == 'csv':
+                yield writer.writerow(row)
+            else:
+                record = dict(zip(FIELDS, row))
+                record['images'] = record['images'].split(IMAGE_SEPARATOR) if record['images'] else []
+                yield json.dumps(record) + '\n'
+
+
+catalog_cli = AppGroup('catalog', help='Bulk import and export the product catalog.')
+
+
+@catalog_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows per transaction.')
+def import_command(path, fmt, chunk_size):
+    """Upsert products from a CSV or JSONL feed, keyed on sku."""
+    def progress(report):
+        click.echo(f'{report.rows} rows, {report.created} created, {report.updated} updated, '
+                   f'{report.failed} failed, {report.rows / (time.perf_counter() - report.started):.0f} rows/s')
+
+    with open(path, newline='', encoding='utf-8-sig') as stream:
+        report = import_catalog(stream, fmt or detect_format(path), chunk_size, progress)
+    result = report.as_dict()
+    for error in result['errors']:
+        click.echo(f"line {error['line']} ({error['sku']}): {error['error']}", err=True)
+    click.echo(f"Imported {result['rows']} rows in {result['seconds']}s ({result['rows_per_second']} rows/s): "
+               f"{result['created']} created, {result['updated']} updated, {result['images']} images, "
+               f"{result['failed']} failed")
+
+
+@catalog_cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+def export_command(path, fmt):
+    """Write every product to a CSV or JSONL file."""
+    fmt = fmt or detect_format(path)
+    started = time.perf_counter()
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        for line in export_catalog(fmt):
+            f.write(line)
+            count += 1
+    count -= fmt == 'csv'
+    click.echo(f'Exported {count} products in {time.perf_counter() - started:.2f}s')
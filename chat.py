@@ -0,0 +1,295 @@
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import insert, select
+from models import db, ChatMessage
+
+
+# Live support chat. Every open stream is a generator blocked on its own
+# queue.Queue, so under the gevent workers set up in gunicorn.conf.py an idle
+# conversation costs one greenlet, not one OS thread. Messages are fanned out
+# in process by MemoryBroker; SQLiteBroker relays them between processes.
+
+def _timestamp(message):
+    return datetime.fromisoformat(message['timestamp'])
+
+
+def _key(message):
+    # Rows saved before messages carried an id fall back to their timestamp
+    return message.get('id') or message['timestamp']
+
+
+class MemoryBroker:
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, ticket_id):
+        subscriber = queue.Queue(self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(ticket_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, ticket_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(ticket_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[ticket_id]
+
+    def publish(self, message):
+        self.deliver(message)
+
+    def recent(self, ticket_id, since=None):
+        # Messages published by other processes that may not be saved yet
+        return []
+
+    def deliver(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(message['ticket_id'], ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                # A stalled client drops live messages and catches up by cursor on reconnect
+                pass
+
+    def subscribed(self, ticket_id):
+        with self._lock:
+            return ticket_id in self._subscribers
+
+    def connections(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def close(self):
+        pass
+
+
+# Multi-process relay through a small SQLite event log: publishers append,
+# one poller per process tails it and delivers to that process's streams.
+# The log also backs catch-up, since a message relayed here can reach a
+# stream before the process that posted it has saved it.
+class SQLiteBroker(MemoryBroker):
+    def __init__(self, path, poll_interval=0.25, retention=3600, max_queue=100):
+        super().__init__(max_queue)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+        self._stop = threading.Event()
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS chat_event (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'created_at REAL NOT NULL, ticket_id INTEGER NOT NULL, payload TEXT NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_chat_event_ticket_id ON chat_event (ticket_id, id)')
+        self._last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM chat_event').fetchone()[0]
+        self._thread = threading.Thread(target=self._run, name='chat-broker', daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def publish(self, message):
+        self._connect().execute('INSERT INTO chat_event (created_at, ticket_id, payload) VALUES (?, ?, ?)',
+                                (time.time(), message['ticket_id'], json.dumps(message)))
+
+    def recent(self, ticket_id, since=None):
+        rows = self._connect().execute('SELECT payload FROM chat_event WHERE ticket_id = ? ORDER BY id',
+                                       (ticket_id,)).fetchall()
+        messages = [json.loads(payload) for payload, in rows]
+        return [message for message in messages if since is None or _timestamp(message) > since]
+
+    def _run(self):
+        last_prune = 0
+        while not self._stop.wait(self.poll_interval):
+            conn = self._connect()
+            rows = conn.execute('SELECT id, payload FROM chat_event WHERE id > ? ORDER BY id',
+                                (self._last_id,)).fetchall()
+            for event_id, payload in rows:
+                self._last_id = event_id
+                self.deliver(json.loads(payload))
+            if time.time() - last_prune > 60:
+                conn.execute('DELETE FROM chat_event WHERE created_at < ?', (time.time() - self.retention,))
+                last_prune = time.time()
+
+    def close(self):
+        self._stop.set()
+
+
+class ChatService:
+    def __init__(self):
+        self.broker = None
+        self.flush_interval = 1
+        self.flush_size = 200
+        self.keepalive = 15
+        self._pending = []
+        self._last_timestamp = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._engine = None
+
+    def init_app(self, app):
+        app.config.setdefault('CHAT_BROKER', 'memory')
+        app.config.setdefault('CHAT_BROKER_PATH', os.path.join(app.instance_path, 'chat.db'))
+        app.config.setdefault('CHAT_FLUSH_INTERVAL', 1)
+        app.config.setdefault('CHAT_FLUSH_SIZE', 200)
+        app.config.setdefault('CHAT_KEEPALIVE', 15)
+
+        broker = app.config['CHAT_BROKER']
+        if broker == 'memory':
+            self.broker = MemoryBroker()
+        elif broker == 'sqlite':
+            os.makedirs(os.path.dirname(app.config['CHAT_BROKER_PATH']), exist_ok=True)
+            self.broker = SQLiteBroker(app.config['CHAT_BROKER_PATH'])
+        else:
+            raise ValueError(f'Unknown CHAT_BROKER {broker!r}')
+        self.flush_interval = app.config['CHAT_FLUSH_INTERVAL']
+        self.flush_size = app.config['CHAT_FLUSH_SIZE']
+        self.keepalive = app.config['CHAT_KEEPALIVE']
+        self._app = app
+
+    def post(self, ticket_id, user_id, text):
+        # Publishes at once; the row is written by the next batched flush
+        with self._lock:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            # Strictly increasing per ticket, so a timestamp is a usable cursor
+            last = self._last_timestamp.get(ticket_id)
+            if last is not None and now <= last:
+                now = last + timedelta(microseconds=1)
+            self._last_timestamp[ticket_id] = now
+            message = {'id': uuid.uuid4().hex, 'ticket_id': ticket_id, 'user_id': user_id, 'message': text,
+                       'timestamp': now.isoformat(timespec='microseconds')}
+            self._pending.append(message)
+            pending = len(self._pending)
+        self._ensure_flusher()
+        if pending >= self.flush_size:
+            self._wakeup.set()
+        self.broker.publish(message)
+        return message
+
+    def history(self, ticket_id, since=None, limit=200):
+        # Saved messages after the `since` cursor plus any not yet flushed,
+        # here or, with a relaying broker, in another process. Unsaved ones
+        # are read first: a message flushed in between shows up twice and is
+        # kept once by its id.
+        with self._lock:
+            pending = [message for message in self._pending if message['ticket_id'] == ticket_id
+                       and (since is None or _timestamp(message) > since)]
+        pending = self.broker.recent(ticket_id, since) + pending
+        query = select(ChatMessage.uid, ChatMessage.user_id, ChatMessage.message, ChatMessage.timestamp) \
+            .where(ChatMessage.support_ticket_id == ticket_id)
+        if since is not None:
+            query = query.where(ChatMessage.timestamp > since)
+        rows = db.session.execute(query.order_by(ChatMessage.timestamp.desc()).limit(limit)).all()
+        messages = [{'id': uid, 'ticket_id': ticket_id, 'user_id': user_id, 'message': text,
+                     'timestamp': timestamp.isoformat(timespec='microseconds')}
+                    for uid, user_id, text, timestamp in reversed(rows)]
+        unique = {_key(message): message for message in messages + pending}
+        return sorted(unique.values(), key=_timestamp)[-limit:]
+
+    def stream(self, ticket_id, since=None):
+        # Server-Sent Events: the backlog after `since`, then live messages,
+        # with a comment line every `keepalive` seconds to hold proxies open.
+        # The event id is the timestamp, so EventSource resumes from it.
+        # Subscribing before reading the backlog means nothing posted in
+        # between is missed; what arrives twice is skipped.
+        subscriber = self.broker.subscribe(ticket_id)
+        backlog = self.history(ticket_id, since)
+        sent = {_key(message) for message in backlog}
+
+        def events():
+            try:
+                yield 'retry: 3000\n\n'
+                for message in backlog:
+                    yield self._event(message)
+                while True:
+                    try:
+                        message = subscriber.get(timeout=self.keepalive)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    if _key(message) not in sent:
+                        yield self._event(message)
+            finally:
+                self.broker.unsubscribe(ticket_id, subscriber)
+        return events()
+
+    @staticmethod
+    def _event(message):
+        return f'id: {message["timestamp"]}\nevent: message\ndata: {json.dumps(message)}\n\n'
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            # Ordering state is only kept for tickets still in use here
+            cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=1)
+            for ticket_id in [ticket_id for ticket_id, last in self._last_timestamp.items()
+                              if last < cutoff and not self.broker.subscribed(ticket_id)]:
+                del self._last_timestamp[ticket_id]
+        if not pending:
+            return 0
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(insert(ChatMessage), [
+                    {'support_ticket_id': message['ticket_id'], 'user_id': message['user_id'],
+                     'message': message['message'], 'timestamp': _timestamp(message), 'uid': message['id']}
+                    for message in pending
+                ])
+        except Exception:
+            with self._lock:
+                self._pending = pending + self._pending
+            raise
+        return len(pending)
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            with self._app.app_context():
+                self._engine = db.engine
+            self._thread = threading.Thread(target=self._run, name='chat-flusher', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self._app.logger.exception('Saving chat messages failed')
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        self.broker.close()
+        if self._engine is not None:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'broker': type(self.broker).__name__, 'connections': self.broker.connections(),
+                'pending_writes': pending}
+
+
+chat = ChatService()
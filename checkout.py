@@ -0,0 +1,218 @@
+import os
+import random
+import secrets
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, create_engine, insert, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+import metrics
+from models import db, Product, Category, User, Order, OrderItem, CheckoutRequest, Cart, CartItem
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class OutOfStock(CheckoutError):
+    def __init__(self, product_ids):
+        super().__init__('Not enough stock for products: ' + ', '.join(map(str, product_ids)))
+        self.product_ids = product_ids
+
+
+def merge_lines(lines):
+    # [(product_id, quantity)] -> {product_id: quantity}, duplicates summed
+    merged = {}
+    for product_id, quantity in lines:
+        if quantity <= 0:
+            raise CheckoutError('Quantities must be positive.')
+        merged[product_id] = merged.get(product_id, 0) + quantity
+    if not merged:
+        raise CheckoutError('Your cart is empty.')
+    return merged
+
+
+def existing_order(connection, user_id, idempotency_key):
+    # Keys come from the client, so a replay only ever returns the user's own order
+    return connection.execute(
+        select(CheckoutRequest.order_id).where(CheckoutRequest.idempotency_key == idempotency_key,
+                                               CheckoutRequest.user_id == user_id)
+    ).scalar()
+
+
+# Turns cart lines into an order inside the caller's transaction on
+# `connection`; the caller commits. All stock is reserved by one conditional
+# UPDATE that also returns the prices to snapshot, the order items go in as
+# one executemany, and the idempotency key row is written first so a
+# concurrent retry with the same key fails before touching stock.
+# Returns (order_id, sold_out_product_ids).
+def place_order(connection, user_id, lines, idempotency_key,
+                shipping_address_id=None, billing_address_id=None):
+    quantities = merge_lines(lines)
+
+    connection.execute(insert(CheckoutRequest).values(
+        idempotency_key=idempotency_key, user_id=user_id,
+        created_at=datetime.now(timezone.utc),
+    ))
+
+    wanted = case(quantities, value=Product.id)
+    reserved = connection.execute(
+        Product.__table__.update()
+        .where(Product.id.in_(quantities), Product.stock >= wanted)
+        .values(stock=Product.stock - wanted)
+        .returning(Product.id, Product.stock, Product.price, Product.discount_price)
+    ).all()
+    if len(reserved) != len(quantities):
+        # Nothing has been committed; the caller rolls the reservation back
+        raise OutOfStock(sorted(set(quantities) - {row.id for row in reserved}))
+
+    prices = {row.id: row.discount_price if row.discount_price is not None else row.price
+              for row in reserved}
+    total = round(sum(prices[pid] * qty for pid, qty in quantities.items()), 2)
+    created_at = datetime.now(timezone.utc)
+
+    order_id = connection.execute(insert(Order).values(
+        user_id=user_id, total_price=total, status='Pending', created_at=created_at,
+        shipping_address_id=shipping_address_id, billing_address_id=billing_address_id,
+    )).inserted_primary_key[0]
+    connection.execute(insert(OrderItem), [
+        {'order_id': order_id, 'product_id': pid, 'quantity': qty, 'price': prices[pid]}
+        for pid, qty in quantities.items()
+    ])
+    connection.execute(
+        CheckoutRequest.__table__.update()
+        .where(CheckoutRequest.idempotency_key == idempotency_key)
+        .values(order_id=order_id)
+    )
+
+    # Core inserts skip the ORM events that keep the dashboard rollups current
+    metrics.record_order(connection, created_at, total)
+    metrics.record_order_items(connection, created_at,
+                               [(pid, qty, prices[pid]) for pid, qty in quantities.items()])
+
+    return order_id, [row.id for row in reserved if row.stock == 0]
+
+
+def checkout_cart(user_id, lines, idempotency_key, shipping_address_id=None, billing_address_id=None):
+    # Checks out `lines` from the user's session cart through db.session,
+    # empties their saved cart and commits. Returns the order id, which is
+    # the earlier order for a repeated key.
+    order_id = existing_order(db.session.connection(), user_id, idempotency_key)
+    if order_id is not None:
+        return order_id
+
+    try:
+        connection = db.session.connection()
+        order_id, _ = place_order(connection, user_id, lines, idempotency_key,
+                                  shipping_address_id, billing_address_id)
+        connection.execute(CartItem.__table__.delete().where(
+            CartItem.cart_id.in_(select(Cart.id).where(Cart.user_id == user_id))))
+        # Product pages and listings show stock, and the Core UPDATE skips the
+        # ORM hook that would mark the catalog dirty
+        db.session.info['catalog_dirty'] = True
+        db.session.commit()
+    except IntegrityError:
+        # Lost a race with a retry using the same key, or the key is someone else's
+        db.session.rollback()
+        order_id = existing_order(db.session.connection(), user_id, idempotency_key)
+        if order_id is None:
+            raise CheckoutError('This checkout could not be completed. Please try again.')
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.expire_all()
+    return order_id
+
+
+checkout_cli = AppGroup('checkout', help='Checkout service tools.')
+
+
+@checkout_cli.command('stress')
+@click.option('--threads', default=16, show_default=True)
+@click.option('--attempts', default=400, show_default=True, help='Checkout attempts in total.')
+@click.option('--stock', default=100, show_default=True, help='Starting stock per product.')
+@click.option('--products', default=3, show_default=True)
+def stress_command(threads, attempts, stock, products):
+    """Hammer place_order from many threads on a scratch database and
+    verify nothing is oversold and no idempotency key makes two orders."""
+    path = os.path.join(tempfile.mkdtemp(prefix='checkout-stress-'), 'stress.db')
+    engine = create_engine('sqlite:///' + path, connect_args={'timeout': 60})
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User).values(id=1, username='stress', email='stress@example.com', password='x'))
+        connection.execute(insert(Category).values(id=1, name='stress'))
+        connection.execute(insert(Product), [
+            {'id': pid, 'name': f'p{pid}', 'description': '-', 'category_id': 1,
+             'sku': f'stress-{pid}', 'price': 1.0 + pid, 'stock': stock}
+            for pid in range(1, products + 1)
+        ])
+
+    # A quarter of the attempts reuse an earlier key to simulate retries
+    keys = [secrets.token_hex(8) for _ in range(attempts)]
+    keys = [random.choice(keys[:i]) if i and random.random() < 0.25 else k for i, k in enumerate(keys)]
+    outcomes = {'placed': 0, 'out_of_stock': 0, 'replayed': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def worker(batch):
+        for key in batch:
+            lines = [(random.randint(1, products), random.randint(1, 3)) for _ in range(random.randint(1, 3))]
+            for _ in range(5):
+                try:
+                    with engine.begin() as connection:
+                        if existing_order(connection, 1, key) is not None:
+                            outcome = 'replayed'
+                        else:
+                            place_order(connection, 1, lines, key)
+                            outcome = 'placed'
+                    break
+                except OutOfStock:
+                    outcome = 'out_of_stock'
+                    break
+                except IntegrityError:
+                    outcome = 'replayed'
+                    break
+                except OperationalError:
+                    outcome = 'errors'
+                    time.sleep(0.05)
+            with lock:
+                outcomes[outcome] += 1
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(keys[i::threads],)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with engine.connect() as connection:
+        remaining = dict(connection.execute(select(Product.id, Product.stock)).all())
+        sold = dict(connection.execute(
+            select(OrderItem.product_id, db.func.sum(OrderItem.quantity)).group_by(OrderItem.product_id)
+        ).all())
+        orders = connection.execute(select(db.func.count(Order.id))).scalar()
+        keyed = connection.execute(
+            select(db.func.count(CheckoutRequest.idempotency_key)).where(CheckoutRequest.order_id.isnot(None))
+        ).scalar()
+    engine.dispose()
+
+    problems = []
+    for pid, left in remaining.items():
+        if left < 0:
+            problems.append(f'product {pid} oversold: stock {left}')
+        if left + sold.get(pid, 0) != stock:
+            problems.append(f'product {pid}: {sold.get(pid, 0)} sold + {left} left != {stock}')
+    if orders != keyed or orders != outcomes['placed']:
+        problems.append(f'{orders} orders for {keyed} keys and {outcomes["placed"]} successful checkouts')
+
+    click.echo(f'{attempts} attempts on {threads} threads in {elapsed:.2f}s: ' +
+               ', '.join(f'{k}={v}' for k, v in outcomes.items()))
+    click.echo(f'remaining stock {remaining}, sold {sold}')
+    for problem in problems:
+        click.echo('FAIL: ' + problem, err=True)
+    if problems:
+        raise SystemExit(1)
+    click.echo('OK: no overselling, one order per idempotency key')
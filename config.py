@@ -6,4 +6,84 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    UPLOAD_FOLDER = os.path.join(basedir, 'static/images')
\ No newline at end of file
+    # SQLite takes one writer at a time, so a small pool is enough; reads from
+    # @read_only views use their own pool of SQLITE_READ_POOL_SIZE connections
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 10, 'max_overflow': 5, 'pool_timeout': 10}
+    SQLITE_READ_POOL_SIZE = 20
+    # Pragmas for that pool that differ from database.DEFAULT_PRAGMAS, e.g. (('cache_size', -4096),)
+    SQLITE_READ_PRAGMAS = ()
+    UPLOAD_FOLDER = os.path.join(basedir, 'static/images')
+
+    # Catalog cache: 'memory' (per process) or 'sqlite' (shared between processes)
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'memory'
+    CACHE_DEFAULT_TTL = 300
+    CACHE_STALE_TTL = 60
+    CACHE_MAX_ENTRIES = 1024
+
+    # Seconds shared caches may keep anonymous catalog pages; rendered product cards live longer
+    HTTP_CACHE_MAX_AGE = 60
+    FRAGMENT_CACHE_TTL = 3600
+    # ETags and Last-Modified need the sqlite cache, unless the app runs as one process
+    HTTP_CACHE_SINGLE_PROCESS = os.environ.get('HTTP_CACHE_SINGLE_PROCESS') == '1'
+
+    # Background jobs: threads per queue for the in-process runner and `flask jobs work`.
+    # Set JOBS_LOCAL_WORKER off when dedicated workers run the queue.
+    JOBS_QUEUES = {'default': 2, 'email': 2, 'images': 2}
+    JOBS_LOCAL_WORKER = os.environ.get('JOBS_LOCAL_WORKER', '1') == '1'
+    # Attempts per job, and the first retry delay in seconds (doubled each time, capped)
+    JOBS_MAX_ATTEMPTS = 5
+    JOBS_BACKOFF = 10
+    JOBS_BACKOFF_MAX = 3600
+    # Seconds a claimed job may run before another worker may take it over
+    JOBS_LEASE = 300
+
+    # Outgoing mail; without a server, emails are written to the log
+    MAIL_SERVER = os.environ.get('MAIL_SERVER')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 587))
+    MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
+    MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'shop@localhost')
+    # Where low-stock reorders go, and days before a reordered product may be reordered again
+    INVENTORY_REORDER_EMAIL = os.environ.get('INVENTORY_REORDER_EMAIL', 'purchasing@localhost')
+    INVENTORY_RESTOCK_DAYS = 7
+
+    # Seconds a logged-in user's id/username/is_admin/active stay cached per process, and how many are kept
+    USER_CACHE_TTL = 300
+    USER_CACHE_MAX_ENTRIES = 10000
+
+    # Password hashing: bcrypt cost, and how many hashes may run or wait at once
+    BCRYPT_LOG_ROUNDS = 12
+    PASSWORD_HASH_CONCURRENCY = 2
+    PASSWORD_HASH_MAX_PENDING = 16
+    # Login attempts allowed per (count, seconds)
+    LOGIN_LIMIT_PER_IP = (20, 300)
+    LOGIN_LIMIT_PER_EMAIL = (5, 300)
+
+    # Presence: seconds between batched status writes, and until an active user counts as idle
+    PRESENCE_FLUSH_INTERVAL = 5
+    PRESENCE_IDLE_TIMEOUT = 900
+
+    # Seconds between writes of a logged-in user's session cart to the cart tables
+    CART_PERSIST_INTERVAL = 30
+
+    # Per-request query/render/hash timing, Server-Timing headers and /admin/instrumentation
+    INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION') == '1'
+    # Flag a statement run this many times in one request as a possible N+1
+    INSTRUMENTATION_N_PLUS_ONE = 5
+
+    # Support chat: 'memory' fans messages out within one process, 'sqlite' relays
+    # them between worker processes through CHAT_BROKER_PATH
+    CHAT_BROKER = os.environ.get('CHAT_BROKER', 'memory')
+    # Messages are saved in batches every interval seconds or once this many are waiting
+    CHAT_FLUSH_INTERVAL = 1
+    CHAT_FLUSH_SIZE = 200
+    # Seconds between keepalive comments on an idle chat stream
+    CHAT_KEEPALIVE = 15
+
+    # Recommendations: neighbours kept per product, and seconds after an order
+    # before the incremental update it queued runs (later orders share it)
+    RECOMMENDATIONS_TOP_K = 12
+    RECOMMENDATIONS_UPDATE_DELAY = 300
+    # Pairs seen in fewer orders than this are not recommended; bigger baskets are skipped
+    RECOMMENDATIONS_MIN_COUNT = 1
+    RECOMMENDATIONS_MAX_BASKET = 50
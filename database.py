@@ -0,0 +1,78 @@
+from functools import wraps
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+
+# Applied in order on every new SQLite connection. WAL lets readers run
+# while a writer commits; synchronous=NORMAL is durable across app crashes
+# and only risks the last transactions on power loss. cache_size (KiB when
+# negative) is private to each connection, so it is multiplied by every
+# pooled connection; the mmap'd pages are shared through the OS page cache.
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('busy_timeout', 5000),
+    ('cache_size', -8192),
+    ('mmap_size', 268435456),
+    ('temp_store', 'memory'),
+)
+
+
+def apply_pragmas(dbapi_connection, pragmas, read_only=False):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name} = {value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+    finally:
+        cursor.close()
+
+
+def _listen_for_connections(engine, pragmas, read_only=False):
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas, read_only)
+
+
+def init_app(app, db):
+    # Call after db.init_app: tunes the app's SQLite engines and opens a
+    # second pool of query_only connections for views marked @read_only.
+    # SQLITE_READ_PRAGMAS overrides SQLITE_PRAGMAS for that pool only.
+    app.config.setdefault('SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+    app.config.setdefault('SQLITE_READ_PRAGMAS', ())
+    app.config.setdefault('SQLITE_READ_POOL_SIZE', 20)
+    pragmas = tuple(dict(app.config['SQLITE_PRAGMAS']).items())
+    read_pragmas = tuple(dict(pragmas + tuple(app.config['SQLITE_READ_PRAGMAS'])).items())
+
+    with app.app_context():
+        engine = db.engine
+        for bound in db.engines.values():
+            if bound.dialect.name == 'sqlite':
+                _listen_for_connections(bound, pragmas)
+
+    reader = None
+    if engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        reader = create_engine(engine.url, pool_size=app.config['SQLITE_READ_POOL_SIZE'],
+                               max_overflow=0, pool_timeout=10)
+        _listen_for_connections(reader, read_pragmas, read_only=True)
+    app.extensions['read_only_engine'] = reader
+
+
+def read_only(view):
+    # Routes the view's ORM reads to the read-only pool. Anything it flushes
+    # still goes to the primary engine.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only_db = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('read_only_db'):
+            reader = current_app.extensions.get('read_only_engine')
+            if reader is not None:
+                return reader
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
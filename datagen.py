@@ -0,0 +1,209 @@
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, insert, select
+import auth
+import metrics
+import ratings
+from cache import cache
+from models import (db, User, Address, Category, Product, ProductImage, Order, OrderItem, Review, Payment,
+                    SupportTicket, ChatMessage, InventoryRecord, Contact, Cart, CartItem)
+
+# Every generated user signs in with this password
+PASSWORD = 'password'
+EMAIL_DOMAIN = 'example.com'
+SCALES = {'small': 1000, 'medium': 100000, 'large': 1000000}
+IMAGES = ('black.jpeg', 'blue.jpeg', 'brown.jpeg', 'brown2.jpeg', 'green.jpeg', 'green2.jpeg',
+          'orange.jpeg', 'orange2.jpeg', 'red.jpeg', 'teal.jpeg')
+WORDS = ('classic', 'linen', 'cotton', 'wool', 'denim', 'leather', 'slim', 'relaxed', 'summer', 'winter',
+         'vintage', 'organic', 'striped', 'plain', 'oversized', 'cropped', 'knit', 'canvas', 'suede', 'silk')
+KINDS = ('shirt', 'dress', 'jacket', 'sneaker', 'boot', 'scarf', 'hat', 'bag', 'skirt', 'trouser')
+BRANDS = ('Acme', 'Northwind', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Vandelay', 'Stark')
+CITIES = ('Lagos', 'Abuja', 'London', 'Berlin', 'Nairobi', 'Toronto', 'Austin', 'Lisbon')
+
+
+def product_price(product_id):
+    # Derived from the id so order lines can be priced without keeping
+    # every product in memory
+    return round(5 + (product_id * 7919 % 49500) / 100, 2)
+
+
+def _next_id(connection, model):
+    return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _insert(connection, model, rows):
+    if rows:
+        connection.execute(insert(model), rows)
+
+
+class Generator:
+    def __init__(self, seed, chunk_size, echo=None):
+        self.rng = random.Random(seed)
+        self.chunk_size = chunk_size
+        self.echo = echo or (lambda message: None)
+        self.now = datetime.now(timezone.utc)
+
+    def _when(self, days=365):
+        return self.now - timedelta(seconds=self.rng.randrange(days * 86400))
+
+    def _chunks(self, model, count, build):
+        # build(row_id) -> {model: [rows]}; committed every chunk_size ids
+        with db.engine.connect() as connection:
+            start = _next_id(connection, model)
+        started = time.perf_counter()
+        for offset in range(0, count, self.chunk_size):
+            batch = {}
+            for row_id in range(start + offset, start + min(offset + self.chunk_size, count)):
+                for target, rows in build(row_id).items():
+                    batch.setdefault(target, []).extend(rows)
+            with db.engine.begin() as connection:
+                for target, rows in batch.items():
+                    _insert(connection, target, rows)
+        if count:
+            self.echo(f'{model.__tablename__}: {count} rows in {time.perf_counter() - started:.1f}s')
+        return start, start + count
+
+    def categories(self, count):
+        return self._chunks(Category, count, lambda i: {Category: [{'id': i, 'name': f'Category {i}'}]})
+
+    def users(self, count, password_hash):
+        def build(i):
+            return {
+                User: [{'id': i, 'username': f'user{i}', 'email': f'user{i}@{EMAIL_DOMAIN}',
+                        'password': password_hash, 'fullname': f'User {i}', 'phone': f'+100{i:08d}',
+                        'date_of_birth': date(1960, 1, 1) + timedelta(days=self.rng.randrange(16000)),
+                        'gender': self.rng.choice(('male', 'female')), 'active': True,
+                        'is_admin': False, 'status': 'inactive', 'created_at': self._when(730)}],
+                Address: [{'user_id': i, 'address_type': 'shipping', 'street': f'{i} Market Street',
+                           'city': self.rng.choice(CITIES), 'zip_code': f'{i % 100000:05d}',
+                           'country': 'Nigeria'}],
+            }
+        return self._chunks(User, count, build)
+
+    def products(self, count, categories):
+        def build(i):
+            name = f'{self.rng.choice(WORDS).title()} {self.rng.choice(WORDS)} {self.rng.choice(KINDS)} {i}'
+            price = product_price(i)
+            images = self.rng.sample(IMAGES, self.rng.randint(1, 3))
+            return {
+                Product: [{'id': i, 'name': name, 'description': f'A {name.lower()} made to last. ' * 3,
+                           'category_id': self.rng.randrange(*categories),
+                           'brand': self.rng.choice(BRANDS), 'sku': f'GEN-{i}', 'price': price,
+                           'discount_price': round(price * 0.8, 2) if self.rng.random() < 0.2 else None,
+                           'stock': self.rng.randint(0, 500), 'created_at': self._when()}],
+                ProductImage: [{'product_id': i, 'image_url': f'/static/images/{image}'} for image in images],
+                InventoryRecord: [{'product_id': i, 'quantity_in_stock': self.rng.randint(0, 500),
+                                   'reorder_level': 20, 'supplier_name': self.rng.choice(BRANDS)}],
+            }
+        return self._chunks(Product, count, build)
+
+    def orders(self, count, users, products):
+        def build(i):
+            lines = {self.rng.randrange(*products): self.rng.randint(1, 3) for _ in range(self.rng.randint(1, 4))}
+            total = round(sum(product_price(pid) * qty for pid, qty in lines.items()), 2)
+            created_at = self._when()
+            return {
+                Order: [{'id': i, 'user_id': self.rng.randrange(*users), 'total_price': total,
+                         'status': self.rng.choice(('Pending', 'Shipped', 'Delivered')), 'created_at': created_at}],
+                OrderItem: [{'order_id': i, 'product_id': pid, 'quantity': qty, 'price': product_price(pid)}
+                            for pid, qty in lines.items()],
+                Payment: [{'order_id': i, 'transaction_id': f'GEN-TX-{i}', 'payment_method': 'card',
+                           'amount': total, 'currency': 'USD', 'status': 'Completed', 'transaction_date': created_at}],
+            }
+        return self._chunks(Order, count, build)
+
+    def reviews(self, count, users, products):
+        def build(i):
+            return {Review: [{'id': i, 'user_id': self.rng.randrange(*users),
+                              'product_id': self.rng.randrange(*products),
+                              'rating': self.rng.choices((1, 2, 3, 4, 5), (1, 1, 2, 4, 5))[0],
+                              'review_text': f'Review {i}: {self.rng.choice(WORDS)} and {self.rng.choice(WORDS)}.',
+                              'created_at': self._when()}]}
+        return self._chunks(Review, count, build)
+
+    def tickets(self, count, users):
+        def build(i):
+            user_id = self.rng.randrange(*users)
+            opened = self._when(90)
+            return {
+                SupportTicket: [{'id': i, 'user_id': user_id, 'subject': f'Question about order {i}',
+                                 'description': 'Where is my parcel?', 'status': 'Open', 'created_at': opened}],
+                ChatMessage: [{'support_ticket_id': i, 'user_id': user_id if n % 2 == 0 else None,
+                               'message': f'Message {n} on ticket {i}', 'timestamp': opened + timedelta(minutes=n)}
+                              for n in range(self.rng.randint(1, 6))],
+            }
+        return self._chunks(SupportTicket, count, build)
+
+    def carts(self, count, users, products):
+        def build(i):
+            return {
+                Cart: [{'id': i, 'user_id': self.rng.randrange(*users)}],
+                CartItem: [{'cart_id': i, 'product_id': pid, 'quantity': self.rng.randint(1, 3)}
+                           for pid in {self.rng.randrange(*products) for _ in range(self.rng.randint(1, 4))}],
+            }
+        return self._chunks(Cart, count, build)
+
+    def contacts(self, count):
+        return self._chunks(Contact, count, lambda i: {Contact: [{
+            'id': i, 'first_name': 'Visitor', 'last_name': str(i), 'email': f'visitor{i}@{EMAIL_DOMAIN}',
+            'message': 'Do you ship abroad?', 'created_at': self._when(90)}]})
+
+
+def populate(products, users=None, orders=None, reviews=None, tickets=None, seed=0, chunk_size=5000, echo=None):
+    # Appends a synthetic data set after whatever is already in the database.
+    # Users default to a tenth of the products, orders to half, reviews to one
+    # per product; the rollups and ratings are rebuilt at the end.
+    users = max(users if users is not None else products // 10, 1)
+    orders = orders if orders is not None else products // 2
+    reviews = reviews if reviews is not None else products
+    tickets = tickets if tickets is not None else users // 10
+    generator = Generator(seed, chunk_size, echo)
+
+    password_hash = auth.passwords.hash(PASSWORD)
+    category_ids = generator.categories(max(products // 500, 5))
+    user_ids = generator.users(users, password_hash)
+    with db.engine.begin() as connection:
+        connection.execute(User.__table__.update().where(User.id == user_ids[0]).values(is_admin=True))
+    product_ids = generator.products(products, category_ids)
+    generator.orders(orders, user_ids, product_ids)
+    generator.reviews(reviews, user_ids, product_ids)
+    generator.tickets(tickets, user_ids)
+    generator.carts(users // 10, user_ids, product_ids)
+    generator.contacts(max(users // 100, 1))
+
+    # Core inserts skip the events that maintain these
+    with db.engine.begin() as connection:
+        ratings.rebuild(connection)
+        totals = metrics.rebuild(connection)
+    cache.invalidate()
+    return {'admin_email': f'user{user_ids[0]}@{EMAIL_DOMAIN}', **totals}
+
+
+datagen_cli = AppGroup('datagen', help='Generate synthetic data for benchmarks.')
+
+
+@datagen_cli.command('populate')
+@click.option('--scale', type=click.Choice(list(SCALES)), default='small', show_default=True,
+              help='Sets the product count: small=1k, medium=100k, large=1M.')
+@click.option('--products', type=int, help='Overrides the product count set by --scale.')
+@click.option('--users', type=int)
+@click.option('--orders', type=int)
+@click.option('--reviews', type=int)
+@click.option('--tickets', type=int)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows per transaction.')
+def populate_command(scale, products, users, orders, reviews, tickets, seed, chunk_size):
+    """Bulk-insert users, catalog, orders, reviews and tickets. Every
+    generated user's password is 'password'; the first one is an admin."""
+    if current_app.config['SQLALCHEMY_DATABASE_URI'].endswith('/app.db'):
+        click.confirm('This adds synthetic rows to app.db. Continue?', abort=True)
+    started = time.perf_counter()
+    db.create_all()
+    result = populate(products if products is not None else SCALES[scale], users, orders, reviews, tickets,
+                      seed, chunk_size, echo=click.echo)
+    click.echo(', '.join(f'{k}={v}' for k, v in result.items()))
+    click.echo(f'Done in {time.perf_counter() - started:.1f}s')
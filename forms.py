@@ -1,8 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, TextAreaField, DecimalField, IntegerField, SelectField, DateField, BooleanField, EmailField, TelField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, NumberRange
-from wtforms_alchemy.fields import QuerySelectField
-from models import Category, User
+from flask_wtf.file import MultipleFileField, FileField, FileAllowed, FileRequired
+from wtforms import StringField, PasswordField, SubmitField, TextAreaField, DecimalField, IntegerField, SelectField, DateField, BooleanField, EmailField, TelField, HiddenField
+from wtforms.validators import DataRequired, InputRequired, Email, EqualTo, Length, NumberRange, Optional
+from models import User
 
 # User Registration Form
 class RegistrationForm(FlaskForm):
@@ -28,14 +28,20 @@ class LoginForm(FlaskForm):
 class ProductForm(FlaskForm):
     name = StringField('Name', validators=[DataRequired()])
     description = TextAreaField('Description', validators=[DataRequired()])
-    category = QuerySelectField('Category', query_factory=lambda: Category.query.order_by('name').all(), get_label='name', allow_blank=True)
+    category = SelectField('Category', coerce=int, validators=[DataRequired()])
     brand = StringField('Brand')
     sku = StringField('SKU', validators=[DataRequired()])
     price = DecimalField('Price', validators=[DataRequired(), NumberRange(min=0)])
-    discount_price = DecimalField('Discount Price', validators=[NumberRange(min=0)])
+    discount_price = DecimalField('Discount Price', validators=[Optional(), NumberRange(min=0)])
     stock = IntegerField('Stock', validators=[DataRequired(), NumberRange(min=0)])
+    images = MultipleFileField('Images', validators=[FileAllowed(['jpg', 'jpeg', 'png', 'webp'], 'Images only!')])
     submit = SubmitField('Add Product')
 
+# Bulk catalog feed upload
+class CatalogImportForm(FlaskForm):
+    feed = FileField('Catalog feed', validators=[FileRequired(), FileAllowed(['csv', 'jsonl', 'ndjson', 'json'], 'CSV or JSONL only!')])
+    submit = SubmitField('Import')
+
 # Review Form
 class ReviewForm(FlaskForm):
     rating = SelectField('Rating', choices=[(1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5')], coerce=int, validators=[DataRequired()])
@@ -59,6 +65,20 @@ class SupportTicketForm(FlaskForm):
     priority = SelectField('Priority', choices=[('Low', 'Low'), ('Medium', 'Medium'), ('High', 'High')], validators=[DataRequired()])
     submit = SubmitField('Submit Ticket')
 
+class ChatMessageForm(FlaskForm):
+    message = TextAreaField('Message', validators=[DataRequired(), Length(max=2000)])
+    submit = SubmitField('Send')
+
+# Checkout Form
+class CheckoutForm(FlaskForm):
+    idempotency_key = HiddenField(validators=[DataRequired(), Length(min=8, max=64)])
+    shipping_address_id = SelectField('Ship to', coerce=int, validate_choice=False, validators=[Optional()])
+    submit = SubmitField('Place order')
+
+class CartForm(FlaskForm):
+    quantity = IntegerField('Quantity', default=1, validators=[InputRequired(), NumberRange(min=0, max=99)])
+    submit = SubmitField('Add to cart')
+
 class ContactForm(FlaskForm):
     first_name = StringField('First Name', validators=[DataRequired()])
     last_name = StringField('Last Name', validators=[DataRequired()])
@@ -0,0 +1,21 @@
+import multiprocessing
+import os
+
+# Production server: gunicorn main:app (this file is read from the working
+# directory). gevent workers serve every request, and so every open support
+# chat stream, on a greenlet instead of an OS thread. The worker patches the
+# standard library before it imports the app.
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gevent'
+# Open connections per worker, idle chat streams included
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Several workers only agree on chat messages and catalog invalidations when
+# they go through the shared SQLite broker and cache
+if workers > 1:
+    os.environ.setdefault('CHAT_BROKER', 'sqlite')
+    os.environ.setdefault('CACHE_TYPE', 'sqlite')
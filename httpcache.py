@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from functools import wraps
+from flask import current_app, make_response, render_template, request, session
+from flask_login import current_user
+from markupsafe import Markup
+import cart
+from cache import cache
+from images import image_srcset
+
+
+def template_version(app):
+    # Changes whenever a template file does, so a deploy never answers 304
+    # with markup from the old templates
+    digest = hashlib.sha1()
+    for root, _, files in sorted(os.walk(os.path.join(app.root_path, app.template_folder))):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            digest.update(f'{name}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+    return digest.hexdigest()[:12]
+
+
+def init_app(app):
+    app.config.setdefault('HTTP_CACHE_MAX_AGE', 60)
+    app.config.setdefault('FRAGMENT_CACHE_TTL', 3600)
+    app.config.setdefault('HTTP_CACHE_SINGLE_PROCESS', False)
+    # Validators come from the catalog generation. A memory cache keeps one
+    # per process, so workers would disagree and could answer 304 for a page
+    # another worker has changed; without a shared cache they are only sent
+    # when the app is known to run as a single process.
+    app.extensions['http_validators'] = cache.backend.shared or app.config['HTTP_CACHE_SINGLE_PROCESS']
+    app.extensions['template_version'] = template_version(app)
+    app.jinja_env.globals.update(product_card=product_card)
+
+
+def product_card(product):
+    # A card is cached under a hash of everything it shows, so a catalog
+    # write only re-renders the cards whose product actually changed
+    content = json.dumps([product, image_srcset(product.get('image_url'))], sort_keys=True, default=str)
+    version = hashlib.sha1(content.encode()).hexdigest()[:16]
+    key = f'card:{product["id"]}:{version}:{current_app.extensions["template_version"]}'
+    return Markup(cache.fragment(key, lambda: render_template('_product_card.html', product=product),
+                                 current_app.config['FRAGMENT_CACHE_TTL']))
+
+
+def conditional(view):
+    # ETag/Last-Modified for pages that only change with the catalog. The
+    # navbar shows the login state and cart size, so those are part of the
+    # ETag; visitors with an empty session get a public response a reverse
+    # proxy may share, everyone else a private one that must revalidate.
+    # Without a shared catalog generation only the Cache-Control part applies.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        validators = current_app.extensions['http_validators']
+        anonymous = not session and not current_user.is_authenticated
+        not_modified = False
+        if validators:
+            viewer = 'anonymous' if anonymous else f'{current_user.get_id()}:{cart.count()}'
+            etag = hashlib.sha1(':'.join([
+                str(cache.generation()), current_app.extensions['template_version'], request.full_path, viewer,
+            ]).encode()).hexdigest()
+            last_modified = datetime.fromtimestamp(int(cache.modified_at()), timezone.utc)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                # Last-Modified is only sent to anonymous visitors, see below
+                not_modified = anonymous and request.if_modified_since is not None \
+                    and request.if_modified_since >= last_modified
+        if not_modified:
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        # A view that started a session (a flash, a CSRF token) is not shareable
+        if anonymous and not session.modified:
+            response.cache_control.public = True
+            response.cache_control.max_age = current_app.config['HTTP_CACHE_MAX_AGE']
+            if validators:
+                response.last_modified = last_modified
+        else:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        if validators:
+            response.set_etag(etag)
+        response.vary.add('Cookie')
+        return response
+    return wrapper
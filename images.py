@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import click
+from flask import current_app, url_for
+from flask.cli import AppGroup
+from PIL import Image, ImageOps
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from jobs import jobs
+from models import db, ProductImage
+
+VARIANT_WIDTHS = (320, 640, 1280)
+VARIANT_FORMATS = {'jpeg': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+                   'webp': ('webp', {'quality': 80, 'method': 4})}
+DERIVED_DIR = os.path.join('images', 'derived')
+# Bump when the resize settings change so every image is regenerated
+PIPELINE_VERSION = 1
+# Parsed manifests kept per process. Entries expire so variants regenerated
+# or removed by another process are picked up; a miss is remembered briefly
+# so images still waiting for their variants do not hit the disk on every render
+MANIFEST_CACHE_SIZE = 4096
+MANIFEST_TTL = 300
+MISSING_MANIFEST_TTL = 30
+
+_manifests = OrderedDict()
+_manifests_lock = threading.Lock()
+
+
+def source_path(static_folder, static_url_path, image_url):
+    # Maps a ProductImage.image_url to the file under static/, or None for
+    # images hosted elsewhere.
+    if image_url.startswith(('http://', 'https://', '//')):
+        return None
+    prefix = static_url_path.rstrip('/') + '/'
+    relative = image_url[len(prefix):] if image_url.startswith(prefix) else image_url.lstrip('/')
+    path = os.path.normpath(os.path.join(static_folder, relative))
+    if not path.startswith(os.path.normpath(static_folder) + os.sep):
+        return None
+    return path
+
+
+def manifest_path(static_folder, path):
+    relative = os.path.relpath(path, static_folder).replace(os.sep, '__')
+    return os.path.join(static_folder, DERIVED_DIR, relative + '.json')
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_up_to_date(static_folder, path):
+    try:
+        with open(manifest_path(static_folder, path)) as f:
+            manifest = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('version') != PIPELINE_VERSION:
+        return False
+    if (manifest.get('mtime'), manifest.get('size')) != (stat.st_mtime, stat.st_size):
+        # Touched but possibly unchanged; the content hash decides
+        if manifest.get('digest') != file_digest(path):
+            return False
+    out_dir = os.path.join(static_folder, DERIVED_DIR)
+    return all(os.path.exists(os.path.join(out_dir, name))
+               for variants in manifest['variants'].values() for _, name in variants)
+
+
+# Runs in worker threads and in backfill processes, so it only takes plain
+# paths and returns the manifest instead of touching app state.
+def generate_variants(static_folder, path):
+    out_dir = os.path.join(static_folder, DERIVED_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    digest = file_digest(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    stat = os.stat(path)
+
+    with Image.open(path) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'L'):
+            original = original.convert('RGBA') if 'A' in original.getbands() else original.convert('RGB')
+        widths = [w for w in VARIANT_WIDTHS if w < original.width] or [original.width]
+
+        variants = {fmt: [] for fmt in VARIANT_FORMATS}
+        for width in widths:
+            height = max(1, round(original.height * width / original.width))
+            resized = original.resize((width, height), Image.LANCZOS)
+            for fmt, (ext, options) in VARIANT_FORMATS.items():
+                image = resized
+                if fmt == 'jpeg' and image.mode == 'RGBA':
+                    image = Image.new('RGB', image.size, 'white')
+                    image.paste(resized, mask=resized.getchannel('A'))
+                name = f'{stem}-{digest[:12]}-{width}.{ext}'
+                target = os.path.join(out_dir, name)
+                if not os.path.exists(target):
+                    tmp = target + '.tmp'
+                    image.save(tmp, fmt.upper(), **options)
+                    os.replace(tmp, target)
+                variants[fmt].append((width, name))
+
+    manifest = {'version': PIPELINE_VERSION, 'digest': digest, 'mtime': stat.st_mtime,
+                'size': stat.st_size, 'variants': variants}
+    target = manifest_path(static_folder, path)
+    with open(target + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(target + '.tmp', target)
+    return manifest
+
+
+# Variants are generated by the job queue, so the request that uploaded an
+# image never waits for resizing and a restart does not lose the work
+@jobs.task('images.variants', queue='images', max_attempts=3)
+def _variants_job(image_url):
+    app = current_app
+    path = source_path(app.static_folder, app.static_url_path, image_url)
+    if path is None or not os.path.exists(path) or is_up_to_date(app.static_folder, path):
+        return
+    _remember_manifest(image_url, generate_variants(app.static_folder, path))
+
+
+def schedule_variants(image_urls):
+    image_urls = sorted(set(image_urls))
+    if image_urls:
+        jobs.enqueue_many('images.variants', [{'image_url': url} for url in image_urls],
+                          unique_keys=[f'images.variants:{url}' for url in image_urls])
+
+
+# New ProductImage rows are queued once their transaction commits
+@event.listens_for(ProductImage, 'after_insert')
+def _queue_new_image(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault('new_images', []).append(target.image_url)
+
+
+@event.listens_for(Session, 'after_commit')
+def _schedule_after_commit(session):
+    image_urls = session.info.pop('new_images', None)
+    if image_urls:
+        schedule_variants(image_urls)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('new_images', None)
+
+
+def _remember_manifest(image_url, manifest):
+    expires_at = time.monotonic() + (MANIFEST_TTL if manifest else MISSING_MANIFEST_TTL)
+    with _manifests_lock:
+        _manifests[image_url] = (manifest, expires_at)
+        _manifests.move_to_end(image_url)
+        while len(_manifests) > MANIFEST_CACHE_SIZE:
+            _manifests.popitem(last=False)
+
+
+def _manifest_for(image_url):
+    with _manifests_lock:
+        entry = _manifests.get(image_url)
+        if entry is not None and entry[1] > time.monotonic():
+            _manifests.move_to_end(image_url)
+            return entry[0]
+    path = source_path(current_app.static_folder, current_app.static_url_path, image_url)
+    manifest = None
+    if path is not None:
+        try:
+            with open(manifest_path(current_app.static_folder, path)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+    _remember_manifest(image_url, manifest)
+    return manifest
+
+
+# Template helpers. Until an image's variants exist they fall back to the
+# original, so a freshly uploaded image still renders.
+def image_srcset(image_url, fmt='jpeg'):
+    manifest = _manifest_for(image_url) if image_url else None
+    if not manifest:
+        return ''
+    return ', '.join(f"{url_for('static', filename='images/derived/' + name)} {width}w"
+                     for width, name in manifest['variants'][fmt])
+
+
+def image_variant(image_url, width, fmt='jpeg'):
+    manifest = _manifest_for(image_url) if image_url else None
+    if not manifest:
+        return image_url
+    variants = manifest['variants'][fmt]
+    _, name = next(((w, n) for w, n in variants if w >= width), variants[-1])
+    return url_for('static', filename='images/derived/' + name)
+
+
+def init_app(app):
+    app.jinja_env.globals.update(image_srcset=image_srcset, image_variant=image_variant)
+    app.cli.add_command(images_cli)
+
+
+images_cli = AppGroup('images', help='Manage resized product image variants.')
+
+
+@images_cli.command('backfill')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='Worker processes.')
+def backfill_command(workers):
+    """Generate missing or outdated variants for every product image."""
+    app = current_app._get_current_object()
+    image_urls = db.session.scalars(db.select(ProductImage.image_url).distinct()).all()
+    paths = {source_path(app.static_folder, app.static_url_path, url) for url in image_urls}
+    paths = sorted(p for p in paths if p and os.path.exists(p))
+    pending = [p for p in paths if not is_up_to_date(app.static_folder, p)]
+    click.echo(f'{len(paths)} images, {len(paths) - len(pending)} up to date, {len(pending)} to process')
+
+    started = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(generate_variants, app.static_folder, p): p for p in pending}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                click.echo(f'{futures[future]}: {e}', err=True)
+    click.echo(f'Processed {len(pending) - failed} images in {time.perf_counter() - started:.2f}s, {failed} failed')
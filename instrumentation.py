@@ -0,0 +1,235 @@
+import heapq
+import threading
+import time
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from models import db
+
+# Upper bounds in milliseconds; the last bucket takes everything slower
+BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+# Counts of observations per bucket over the last `window` seconds, kept as
+# a ring of `slot`-second slots so old samples age out without a sweep.
+class RollingHistogram:
+    def __init__(self, window=300, slot=10):
+        self.slot = slot
+        self.slots = [[0, [0] * (len(BUCKETS) + 1), 0.0] for _ in range(window // slot)]
+
+    def _current(self):
+        stamp = int(time.time() // self.slot)
+        current = self.slots[stamp % len(self.slots)]
+        if current[0] != stamp:
+            current[0] = stamp
+            current[1] = [0] * (len(BUCKETS) + 1)
+            current[2] = 0.0
+        return current
+
+    def observe(self, value):
+        current = self._current()
+        index = next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))
+        current[1][index] += 1
+        current[2] += value
+
+    def snapshot(self):
+        oldest = int(time.time() // self.slot) - len(self.slots) + 1
+        counts = [0] * (len(BUCKETS) + 1)
+        total = 0.0
+        for stamp, slot_counts, slot_total in self.slots:
+            if stamp >= oldest:
+                counts = [a + b for a, b in zip(counts, slot_counts)]
+                total += slot_total
+        count = sum(counts)
+        return {
+            'count': count,
+            'mean': round(total / count, 2) if count else None,
+            'p50': self._quantile(counts, count, 0.5),
+            'p95': self._quantile(counts, count, 0.95),
+            'p99': self._quantile(counts, count, 0.99),
+            'buckets': {f'le_{bound}': n for bound, n in zip(BUCKETS, counts)} | {'inf': counts[-1]},
+        }
+
+    @staticmethod
+    def _quantile(counts, count, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not count:
+            return None
+        seen = 0
+        for bound, n in zip(BUCKETS + (None,), counts):
+            seen += n
+            if seen >= q * count:
+                return bound
+        return None
+
+
+class EndpointStats:
+    def __init__(self, window):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.timings = {name: RollingHistogram(window) for name in ('total', 'sql', 'render', 'hash')}
+        self.slowest = {}
+        self.repeated = {}
+
+
+# Opt-in per-request profiling: query count and SQL time from cursor events,
+# template render time from Flask's render signals, and password hashing
+# time reported by auth. Each request gets a Server-Timing header, and the
+# totals roll up per endpoint for the admin stats page.
+class Instrumentation:
+    def __init__(self):
+        self.enabled = False
+        self.n_plus_one_threshold = 5
+        self.slowest_kept = 5
+        self.window = 300
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION_ENABLED', False)
+        app.config.setdefault('INSTRUMENTATION_N_PLUS_ONE', 5)
+        app.config.setdefault('INSTRUMENTATION_WINDOW', 300)
+        self.enabled = app.config['INSTRUMENTATION_ENABLED']
+        if not self.enabled:
+            return
+        self.n_plus_one_threshold = app.config['INSTRUMENTATION_N_PLUS_ONE']
+        self.window = app.config['INSTRUMENTATION_WINDOW']
+        self._app = app
+
+        with app.app_context():
+            engines = list(db.engines.values())
+        if app.extensions.get('read_only_engine') is not None:
+            engines.append(app.extensions['read_only_engine'])
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(engine, 'handle_error', self._handle_error)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def _trace(self):
+        return g.get('request_trace') if has_request_context() else None
+
+    def _start(self):
+        g.request_trace = {'started': time.perf_counter(), 'queries': 0, 'sql': 0.0, 'render': 0.0,
+                           'hash': 0.0, 'statements': {}, 'render_started': []}
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._trace() is not None:
+            conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        trace = self._trace()
+        if trace is None or not conn.info.get('query_started'):
+            return
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        trace['queries'] += 1
+        trace['sql'] += elapsed
+        # Statements are parameterised, so the same text means the same query
+        # with different values: the signature of an N+1
+        count, total = trace['statements'].get(statement, (0, 0.0))
+        trace['statements'][statement] = (count + 1, total + elapsed)
+
+    @staticmethod
+    def _handle_error(exception_context):
+        # A failed statement never reaches after_cursor_execute; drop its start
+        # time so the next statement on this connection is not timed from it
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_started'):
+            conn.info['query_started'].pop()
+
+    def _before_render(self, sender, template, context, **extra):
+        trace = self._trace()
+        if trace is not None:
+            trace['render_started'].append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        # Templates rendered inside another render (cached fragments) are
+        # already part of the outer render's time
+        trace = self._trace()
+        if trace is not None and trace['render_started']:
+            started = trace['render_started'].pop()
+            if not trace['render_started']:
+                trace['render'] += time.perf_counter() - started
+
+    def record(self, name, seconds):
+        # For work outside SQL and templates, e.g. password hashing
+        trace = self._trace() if self.enabled else None
+        if trace is not None:
+            trace[name] = trace.get(name, 0.0) + seconds
+
+    def _finish(self, response):
+        trace = g.pop('request_trace', None)
+        if trace is None:
+            return response
+        total = time.perf_counter() - trace['started']
+        # Render time includes the queries templates trigger, so it is
+        # reported as is rather than subtracted from
+        timings = {'total': total, 'sql': trace['sql'], 'render': trace['render'], 'hash': trace['hash']}
+        response.headers['Server-Timing'] = ', '.join([
+            f'sql;dur={trace["sql"] * 1000:.1f};desc="{trace["queries"]} queries"',
+            f'render;dur={trace["render"] * 1000:.1f}',
+            f'hash;dur={trace["hash"] * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+        self._aggregate(request.endpoint or 'unknown', trace, timings)
+        return response
+
+    def _aggregate(self, endpoint, trace, timings):
+        repeated = {statement: count for statement, (count, _) in trace['statements'].items()
+                    if count >= self.n_plus_one_threshold}
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats(self.window)
+            stats.requests += 1
+            stats.queries += trace['queries']
+            stats.max_queries = max(stats.max_queries, trace['queries'])
+            for name, seconds in timings.items():
+                stats.timings[name].observe(seconds * 1000)
+            for statement, (count, seconds) in trace['statements'].items():
+                mean = seconds / count
+                if mean > stats.slowest.get(statement, 0):
+                    stats.slowest[statement] = mean
+            if len(stats.slowest) > 4 * self.slowest_kept:
+                stats.slowest = dict(heapq.nlargest(self.slowest_kept, stats.slowest.items(),
+                                                    key=lambda item: item[1]))
+            for statement, count in repeated.items():
+                seen = stats.repeated.setdefault(statement, {'requests': 0, 'max_repeats': 0})
+                if not seen['requests']:
+                    self._app.logger.warning('Possible N+1 in %s: statement ran %d times in one request: %s',
+                                             endpoint, count, statement[:200])
+                seen['requests'] += 1
+                seen['max_repeats'] = max(seen['max_repeats'], count)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'window_seconds': self.window,
+                'endpoints': {
+                    endpoint: {
+                        'requests': stats.requests,
+                        'queries_per_request': round(stats.queries / stats.requests, 2),
+                        'max_queries': stats.max_queries,
+                        'timings_ms': {name: histogram.snapshot() for name, histogram in stats.timings.items()},
+                        'slowest_statements': [
+                            {'mean_ms': round(seconds * 1000, 2), 'statement': statement}
+                            for statement, seconds in heapq.nlargest(self.slowest_kept, stats.slowest.items(),
+                                                                     key=lambda item: item[1])
+                        ],
+                        'possible_n_plus_one': [{'statement': statement, **seen}
+                                                for statement, seen in stats.repeated.items()],
+                    }
+                    for endpoint, stats in sorted(self._endpoints.items())
+                },
+            }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+instrumentation = Instrumentation()
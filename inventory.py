@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import or_, select, true
+import mail
+from jobs import jobs
+from models import db, Product, InventoryRecord
+
+
+def init_app(app):
+    app.config.setdefault('INVENTORY_REORDER_EMAIL', 'purchasing@localhost')
+    app.config.setdefault('INVENTORY_RESTOCK_DAYS', 7)
+
+
+# Sales take stock off Product.stock; InventoryRecord keeps each product's
+# reorder level and supplier. A scan copies the live stock across, clears the
+# restock date of products that were restocked, and marks the products that
+# fell to their reorder level, emailing one reorder per supplier. A marked
+# product is only reordered again if its restock date passes with the stock
+# still low, so running a scan twice is harmless.
+def reorder_scan(product_ids=None):
+    records = InventoryRecord.__table__
+    scope = records.c.product_id.in_(product_ids) if product_ids else true()
+    now = datetime.now(timezone.utc)
+    with db.engine.begin() as connection:
+        connection.execute(records.update().where(scope).values(
+            quantity_in_stock=select(Product.stock).where(Product.id == records.c.product_id).scalar_subquery()))
+        connection.execute(records.update().where(
+            scope, records.c.quantity_in_stock > records.c.reorder_level, records.c.restock_date.isnot(None),
+        ).values(restock_date=None))
+        low = connection.execute(
+            records.update().where(
+                scope, records.c.quantity_in_stock <= records.c.reorder_level,
+                or_(records.c.restock_date.is_(None), records.c.restock_date < now),
+            ).values(restock_date=now + timedelta(days=current_app.config['INVENTORY_RESTOCK_DAYS']))
+            .returning(records.c.product_id, records.c.quantity_in_stock, records.c.reorder_level,
+                       records.c.supplier_name)
+        ).all()
+        names = dict(connection.execute(
+            select(Product.id, Product.name).where(Product.id.in_([row.product_id for row in low]))).all()) if low else {}
+
+    by_supplier = {}
+    for row in low:
+        by_supplier.setdefault(row.supplier_name or 'Unknown supplier', []).append(
+            {'product_id': row.product_id, 'name': names.get(row.product_id), 'stock': row.quantity_in_stock,
+             'reorder_level': row.reorder_level})
+    for supplier, products in sorted(by_supplier.items()):
+        mail.send(current_app.config['INVENTORY_REORDER_EMAIL'], f'Reorder from {supplier}', 'reorder',
+                  supplier=supplier, products=products)
+    return len(low)
+
+
+@jobs.task('inventory.reorder_scan', max_attempts=3)
+def _reorder_scan_job(product_ids=None):
+    reorder_scan(product_ids)
+
+
+def schedule_scan(product_ids=None):
+    jobs.enqueue('inventory.reorder_scan', {'product_ids': sorted(product_ids) if product_ids else None})
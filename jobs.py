@@ -0,0 +1,392 @@
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from models import db
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+class Task:
+    def __init__(self, name, func, queue, max_attempts):
+        self.name = name
+        self.func = func
+        self.queue = queue
+        self.max_attempts = max_attempts
+
+
+# Durable job queue in its own SQLite file, so enqueueing never waits on the
+# main database's write lock and needs no external service. A job is claimed
+# with one atomic UPDATE ... RETURNING and leased for `lease` seconds; a
+# worker that dies mid-job loses the lease and the job runs again, so
+# handlers must be safe to repeat. Failures retry with exponential backoff
+# until max_attempts, then stay 'failed' for `flask jobs retry`.
+class JobQueue:
+    def __init__(self):
+        self.path = None
+        self.tasks = {}
+        self.queues = {'default': 2}
+        self.max_attempts = 5
+        self.backoff = 10
+        self.backoff_max = 3600
+        self.lease = 300
+        self.poll_interval = 1
+        self.retention = 86400
+        self._local = threading.local()
+        self._local_worker = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_DATABASE_PATH', os.path.join(app.instance_path, 'jobs.db'))
+        app.config.setdefault('JOBS_QUEUES', {'default': 2})
+        app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOBS_BACKOFF', 10)
+        app.config.setdefault('JOBS_BACKOFF_MAX', 3600)
+        app.config.setdefault('JOBS_LEASE', 300)
+        app.config.setdefault('JOBS_POLL_INTERVAL', 1)
+        app.config.setdefault('JOBS_RETENTION', 86400)
+        app.config.setdefault('JOBS_LOCAL_WORKER', True)
+
+        self.path = app.config['JOBS_DATABASE_PATH']
+        self.queues = dict(app.config['JOBS_QUEUES'])
+        self.max_attempts = app.config['JOBS_MAX_ATTEMPTS']
+        self.backoff = app.config['JOBS_BACKOFF']
+        self.backoff_max = app.config['JOBS_BACKOFF_MAX']
+        self.lease = app.config['JOBS_LEASE']
+        self.poll_interval = app.config['JOBS_POLL_INTERVAL']
+        self.retention = app.config['JOBS_RETENTION']
+        self.local_worker = app.config['JOBS_LOCAL_WORKER']
+        self._app = app
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS job ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, name TEXT NOT NULL, '
+            "payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', "
+            'attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, unique_key TEXT, '
+            'run_at REAL NOT NULL, locked_until REAL, worker TEXT, last_error TEXT, '
+            'created_at REAL NOT NULL, finished_at REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_job_ready ON job (queue, status, run_at)')
+        # At most one waiting copy of a job with a unique key; a copy may
+        # still be running, so changes made while it runs are not missed
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_job_unique_key ON job (unique_key) "
+                     "WHERE status = 'queued'")
+        app.cli.add_command(jobs_cli)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def task(self, name, queue='default', max_attempts=None):
+        def register(func):
+            self.tasks[name] = Task(name, func, queue, max_attempts)
+            return func
+        return register
+
+    def enqueue(self, name, payload=None, delay=0, unique_key=None):
+        # Returns the job id, or None when an identical unique job is already waiting
+        return self.enqueue_many(name, [payload or {}], delay, [unique_key])[0]
+
+    def enqueue_many(self, name, payloads, delay=0, unique_keys=None):
+        task = self.tasks[name]
+        now = time.time()
+        unique_keys = unique_keys or [None] * len(payloads)
+        conn = self._connect()
+        ids = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for payload, unique_key in zip(payloads, unique_keys):
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO job (queue, name, payload, max_attempts, unique_key, run_at, created_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (task.queue, name, json.dumps(payload), task.max_attempts or self.max_attempts,
+                     unique_key, now + delay, now),
+                )
+                ids.append(cursor.lastrowid if cursor.rowcount else None)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._wake_local_worker()
+        return ids
+
+    def claim(self, queue, worker_id):
+        # (id, name, payload, attempts, max_attempts) of the next due job, or None
+        now = time.time()
+        row = self._connect().execute(
+            "UPDATE job SET status = 'running', attempts = attempts + 1, locked_until = ?, worker = ? "
+            "WHERE id = (SELECT id FROM job WHERE queue = ? AND status = 'queued' AND run_at <= ? "
+            "ORDER BY run_at, id LIMIT 1) "
+            'RETURNING id, name, payload, attempts, max_attempts',
+            (now + self.lease, worker_id, queue, now),
+        ).fetchall()
+        if not row:
+            return None
+        row = row[0]
+        return row[0], row[1], json.loads(row[2]), row[3], row[4]
+
+    def complete(self, job_id):
+        self._connect().execute(
+            "UPDATE job SET status = 'done', finished_at = ?, locked_until = NULL, last_error = NULL WHERE id = ?",
+            (time.time(), job_id))
+
+    def retry_later(self, job_id, attempts, max_attempts, error):
+        conn = self._connect()
+        if attempts >= max_attempts:
+            conn.execute("UPDATE job SET status = 'failed', finished_at = ?, locked_until = NULL, last_error = ? "
+                         'WHERE id = ?', (time.time(), error, job_id))
+            return
+        # Exponential backoff with jitter, so a failing dependency is not
+        # hit by every retry at the same moment
+        delay = min(self.backoff * 2 ** (attempts - 1), self.backoff_max) * random.uniform(0.5, 1)
+        try:
+            conn.execute("UPDATE job SET status = 'queued', run_at = ?, locked_until = NULL, last_error = ? "
+                         'WHERE id = ?', (time.time() + delay, error, job_id))
+        except sqlite3.IntegrityError:
+            # A newer copy of this unique job is already waiting and will do the work
+            conn.execute('DELETE FROM job WHERE id = ?', (job_id,))
+
+    def requeue_expired(self):
+        # Jobs whose worker died or overran its lease go back in the queue
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                "DELETE FROM job WHERE status = 'running' AND locked_until < ? AND unique_key IN "
+                "(SELECT unique_key FROM job WHERE status = 'queued')", (now,))
+            count = conn.execute(
+                "UPDATE job SET status = 'queued', run_at = ?, locked_until = NULL "
+                "WHERE status = 'running' AND locked_until < ?", (now, now)).rowcount
+            conn.execute("DELETE FROM job WHERE status = 'done' AND finished_at < ?", (now - self.retention,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return count
+
+    def retry_failed(self, job_id=None):
+        query = "UPDATE job SET status = 'queued', attempts = 0, run_at = ?, finished_at = NULL " \
+                "WHERE status = 'failed'"
+        params = (time.time(),)
+        if job_id is not None:
+            query += ' AND id = ?'
+            params += (job_id,)
+        return self._connect().execute(query, params).rowcount
+
+    def run(self, name, payload):
+        task = self.tasks.get(name)
+        if task is None:
+            raise LookupError(f'No task named {name!r}')
+        with self._app.app_context():
+            try:
+                task.func(**payload)
+            finally:
+                db.session.remove()
+
+    def stats(self):
+        now = time.time()
+        rows = self._connect().execute(
+            "SELECT queue, status, COUNT(*), MIN(CASE WHEN status = 'queued' AND run_at <= ? THEN run_at END) "
+            'FROM job GROUP BY queue, status', (now,)).fetchall()
+        report = {}
+        for queue, status, count, oldest in rows:
+            entry = report.setdefault(queue, dict.fromkeys(STATUSES, 0) | {'oldest_due_seconds': None})
+            entry[status] = count
+            if oldest is not None:
+                entry['oldest_due_seconds'] = round(now - oldest, 1)
+        return report
+
+    def _wake_local_worker(self):
+        # Without a separate `flask jobs work` process, the web process runs
+        # jobs itself on a few background threads
+        if not self.local_worker:
+            return
+        if self._local_worker is None:
+            with self._lock:
+                if self._local_worker is None:
+                    self._local_worker = Worker(self, self.queues, name=f'local-{os.getpid()}')
+                    threading.Thread(target=self._local_worker.run, name='jobs-local', daemon=True).start()
+        self._local_worker.wake()
+
+    def after_fork(self):
+        # A forked child must not share the parent's SQLite connections
+        self._local = threading.local()
+        self._local_worker = None
+
+
+class Worker:
+    def __init__(self, queue, concurrency, name=None, burst=False):
+        self.queue = queue
+        self.concurrency = {name: limit for name, limit in concurrency.items() if limit > 0}
+        self.name = name or f'{os.uname().nodename}-{os.getpid()}'
+        self.burst = burst
+        self.processed = 0
+        self.failed = 0
+        self._running = dict.fromkeys(self.concurrency, 0)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self, *args):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _execute(self, queue_name, job):
+        job_id, name, payload, attempts, max_attempts = job
+        try:
+            self.queue.run(name, payload)
+        except Exception as e:
+            self.queue._app.logger.exception('Job %s %s failed (attempt %d of %d)',
+                                             job_id, name, attempts, max_attempts)
+            self.queue.retry_later(job_id, attempts, max_attempts, f'{type(e).__name__}: {e}')
+            outcome = 'failed'
+        else:
+            self.queue.complete(job_id)
+            outcome = 'processed'
+        with self._lock:
+            self._running[queue_name] -= 1
+            setattr(self, outcome, getattr(self, outcome) + 1)
+        self._wakeup.set()
+
+    def run(self):
+        # Each queue gets at most its own number of threads, so a backlog of
+        # image jobs cannot hold up emails
+        last_reap = 0
+        with ThreadPoolExecutor(max_workers=sum(self.concurrency.values()) or 1,
+                                thread_name_prefix='jobs') as pool:
+            while not self._stop.is_set():
+                if time.time() - last_reap > self.queue.lease / 4:
+                    self.queue.requeue_expired()
+                    last_reap = time.time()
+                self._wakeup.clear()
+                claimed = False
+                for queue_name, limit in self.concurrency.items():
+                    while self._running[queue_name] < limit and not self._stop.is_set():
+                        job = self.queue.claim(queue_name, self.name)
+                        if job is None:
+                            break
+                        with self._lock:
+                            self._running[queue_name] += 1
+                        pool.submit(self._execute, queue_name, job)
+                        claimed = True
+                if claimed:
+                    continue
+                with self._lock:
+                    idle = not any(self._running.values())
+                if self.burst and idle:
+                    break
+                self._wakeup.wait(self.queue.poll_interval)
+
+
+jobs = JobQueue()
+
+
+def _worker_process(app, concurrency, burst):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    reader = app.extensions.get('read_only_engine')
+    if reader is not None:
+        reader.dispose(close=False)
+    jobs.after_fork()
+    worker = Worker(jobs, concurrency, burst=burst)
+    signal.signal(signal.SIGTERM, worker.stop)
+    worker.run()
+
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs.')
+
+
+@jobs_cli.command('work')
+@click.option('--queue', 'queues', multiple=True, metavar='NAME[=THREADS]',
+              help='Repeatable; defaults to every queue in JOBS_QUEUES at its configured concurrency.')
+@click.option('--processes', default=1, show_default=True, help='Forked worker processes, each with its own threads.')
+@click.option('--burst', is_flag=True, help='Exit once no job is due.')
+def work_command(queues, processes, burst):
+    """Process jobs until interrupted."""
+    app = current_app._get_current_object()
+    concurrency = dict(jobs.queues)
+    if queues:
+        concurrency = {}
+        for spec in queues:
+            name, _, threads = spec.partition('=')
+            concurrency[name] = int(threads) if threads else jobs.queues.get(name, 1)
+    # Jobs are run by this command's workers, not by the app's local one
+    jobs.local_worker = False
+    click.echo(f'Working {", ".join(f"{name}={n}" for name, n in concurrency.items())} '
+               f'in {processes} process(es)')
+
+    if processes > 1:
+        context = multiprocessing.get_context('fork')
+        children = [context.Process(target=_worker_process, args=(app, concurrency, burst))
+                    for _ in range(processes)]
+        for p in children:
+            p.start()
+        try:
+            for p in children:
+                p.join()
+        except KeyboardInterrupt:
+            for p in children:
+                p.terminate()
+                p.join()
+        return
+
+    worker = Worker(jobs, concurrency, burst=burst)
+    signal.signal(signal.SIGTERM, worker.stop)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+    click.echo(f'{worker.processed} jobs done, {worker.failed} failed attempts')
+
+
+@jobs_cli.command('enqueue')
+@click.argument('name')
+@click.argument('payload', default='{}')
+def enqueue_command(name, payload):
+    """Queue a job by task name with a JSON object of arguments, e.g. from cron."""
+    if name not in jobs.tasks:
+        raise click.ClickException(f'Unknown task {name!r}; known: {", ".join(sorted(jobs.tasks))}')
+    jobs.local_worker = False
+    job_id = jobs.enqueue(name, json.loads(payload))
+    click.echo(f'Queued job {job_id}' if job_id else 'An identical job is already waiting')
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    """Show job counts per queue and status."""
+    click.echo(f"{'queue':<12}" + ''.join(f'{status:>9}' for status in STATUSES) + f"{'oldest':>9}")
+    for queue, entry in sorted(jobs.stats().items()):
+        oldest = entry['oldest_due_seconds']
+        click.echo(f'{queue:<12}' + ''.join(f'{entry[status]:>9}' for status in STATUSES)
+                   + f"{'' if oldest is None else f'{oldest}s':>9}")
+
+
+@jobs_cli.command('retry')
+@click.option('--id', 'job_id', type=int, help='Only this job; defaults to every failed job.')
+def retry_command(job_id):
+    """Queue failed jobs again with a fresh set of attempts."""
+    try:
+        count = jobs.retry_failed(job_id)
+    except sqlite3.IntegrityError:
+        raise click.ClickException('A waiting copy of a failed job already exists; retry by --id instead.')
+    click.echo(f'Requeued {count} job(s)')
@@ -0,0 +1,41 @@
+import smtplib
+from email.message import EmailMessage
+from flask import current_app, render_template
+from jobs import jobs
+
+
+def init_app(app):
+    app.config.setdefault('MAIL_SERVER', None)
+    app.config.setdefault('MAIL_PORT', 587)
+    app.config.setdefault('MAIL_USE_TLS', True)
+    app.config.setdefault('MAIL_USERNAME', None)
+    app.config.setdefault('MAIL_PASSWORD', None)
+    app.config.setdefault('MAIL_DEFAULT_SENDER', 'shop@localhost')
+    app.config.setdefault('MAIL_TIMEOUT', 10)
+
+
+# Emails go out from the job queue, never from a request. The body is
+# rendered from templates/emails/<template>.txt when the job runs.
+def send(to, subject, template, /, **context):
+    jobs.enqueue('mail.send', {'to': to, 'subject': subject, 'template': template, 'context': context})
+
+
+@jobs.task('mail.send', queue='email', max_attempts=8)
+def _send_job(to, subject, template, context):
+    config = current_app.config
+    message = EmailMessage()
+    message['From'] = config['MAIL_DEFAULT_SENDER']
+    message['To'] = to
+    message['Subject'] = subject
+    message.set_content(render_template(f'emails/{template}.txt', **context))
+
+    if not config['MAIL_SERVER']:
+        # Development: no mail server configured, so the message is only logged
+        current_app.logger.info('Email to %s: %s\n%s', to, subject, message.get_content())
+        return
+    with smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=config['MAIL_TIMEOUT']) as smtp:
+        if config['MAIL_USE_TLS']:
+            smtp.starttls()
+        if config['MAIL_USERNAME']:
+            smtp.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        smtp.send_message(message)
@@ -1,18 +1,41 @@
-from flask import Flask, render_template, url_for, flash, redirect, current_app, request
+from flask import Flask, render_template, url_for, flash, redirect, current_app, request, jsonify, abort, Response, stream_with_context
 from flask_login import login_required, current_user, LoginManager, login_user, logout_user
 from flask_bcrypt import Bcrypt
 from config import Config
 from werkzeug.utils import secure_filename
 from PIL import Image
-from models import db, Product, User, Category, Order, Review, Address, SupportTicket, Contact
+from models import db, Product, ProductImage, User, Category, Order, OrderItem, Review, Address, SupportTicket, Contact
 from sqlalchemy.orm import joinedload, Session
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_, func, event, distinct
 from flask_bootstrap import Bootstrap
 from flask_migrate import Migrate
-from forms import ProductForm, LoginForm, RegistrationForm, ReviewForm, AddressForm, SupportTicketForm, ContactForm
-from datetime import datetime
+from forms import ProductForm, LoginForm, RegistrationForm, ReviewForm, AddressForm, SupportTicketForm, ChatMessageForm, ContactForm, CheckoutForm, CartForm, CatalogImportForm
+from catalog import cached_page, category_choices, product_detail, parse_filters, InvalidCursor
+from cache import cache, register_invalidation
+from search import cached_search, search_cli
+import images
+import metrics
+import ratings
+import auth
+from presence import presence
+import checkout
+import cart
+import catalog_io
+import database
+from database import read_only
+from datagen import datagen_cli
+from bench import bench_cli
+from instrumentation import instrumentation
+import httpcache
+from httpcache import conditional
+from chat import chat
+from jobs import jobs
+import mail
+import inventory
+import recommendations
+from datetime import datetime, timezone
 import os
 import secrets
 
@@ -20,7 +43,7 @@ import secrets
 app = Flask(__name__)
 app.config.from_object(Config)
 year = datetime.now().year
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, directory=os.path.join(app.root_path, 'migrations'), render_as_batch=True)
 Bootstrap(app)
 bcrypt = Bcrypt(app)
 login_manager = LoginManager()
@@ -29,15 +52,47 @@ login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
 
 db.init_app(app)
+database.init_app(app, db)
+instrumentation.init_app(app)
+cache.init_app(app)
+jobs.init_app(app)
+mail.init_app(app)
+inventory.init_app(app)
+recommendations.init_app(app)
+register_invalidation(Product, ProductImage, Category, Review)
+app.cli.add_command(search_cli)
+images.init_app(app)
+httpcache.init_app(app)
+app.cli.add_command(metrics.metrics_cli)
+app.cli.add_command(ratings.reviews_cli)
+app.cli.add_command(checkout.checkout_cli)
+app.cli.add_command(catalog_io.catalog_cli)
+app.cli.add_command(datagen_cli)
+app.cli.add_command(bench_cli)
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+login_manager.user_loader(auth.load_user)
+auth.user_cache.init_app(app)
+auth.passwords.init_app(app, bcrypt)
+auth.login_limiter.init_app(app)
+presence.init_app(app)
+chat.init_app(app)
+app.jinja_env.globals.update(cart_count=cart.count)
+
+@app.before_request
+def record_last_seen():
+    if current_user.is_authenticated:
+        presence.touch(current_user.id)
+
+@app.after_request
+def save_cart(response):
+    if current_user.is_authenticated:
+        cart.persist_if_due(current_user.id, app.config['CART_PERSIST_INTERVAL'])
+    return response
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('index'))
     
     login_form = LoginForm()
 
@@ -45,24 +100,43 @@ def login():
 
         email=login_form.email.data
         password=login_form.password.data
+
+        if not auth.login_limiter.allow(request.remote_addr or '', email):
+            flash('Too many login attempts, please wait a few minutes and try again.', 'warning')
+            return render_template("login.html", login_form=login_form), 429
         
         user = User.query.filter_by(email=email).first()
+        try:
+            valid = user is not None and auth.passwords.check(user.password, password)
+        except auth.HasherBusy:
+            flash('We are busy right now, please try again in a moment.', 'warning')
+            return render_template("login.html", login_form=login_form), 503
+
         if not user:
             flash('Incorrect credentials!', 'warning')
             return redirect(url_for('login'))
-        elif not bcrypt.check_password_hash(user.password, password):
+        elif not valid:
                 flash('Incorrect credentials!, please try again.', 'warning')
                 return redirect(url_for('login'))
         else:
+            auth.login_limiter.succeeded(email)
+            # Upgrade hashes made with an older cost factor while we have the password
+            if auth.passwords.needs_rehash(user.password):
+                try:
+                    user.password = auth.passwords.hash(password)
+                    db.session.commit()
+                except auth.HasherBusy:
+                    pass
+
             # Update status to 'active'
             new_status = request.form.get('status')
             if new_status not in ['active', 'inactive']:
                 flash('Invalid status.', 'warning')
                 return redirect(url_for('login'))
             
-            user.status = new_status
-            db.session.commit()
+            presence.set_status(user.id, new_status)
             login_user(user)
+            cart.merge_on_login(user.id)
             
             flash('You have been logged in successfully!', 'success')
             next_page = request.args.get('next')
@@ -80,11 +154,11 @@ def logout():
     try:
         # Update status to 'inactive'
         new_status = request.args.get('status', 'inactive')
-        print(new_status)
-        current_user.status = new_status
-        db.session.commit()
-        print(f"Status after commit: {current_user.status}")
+        if new_status not in ['active', 'inactive']:
+            new_status = 'inactive'
+        presence.set_status(current_user.id, new_status)
 
+        cart.save_on_logout(current_user.id)
         logout_user()
         flash("You have been logged out!", 'success')
     except Exception as e:
@@ -98,6 +172,7 @@ def logout():
 
 
 @app.route('/')
+@conditional
 def index():
     return render_template('index.html')
 
@@ -107,20 +182,37 @@ def admin_dashboard():
     if not current_user.is_admin:
         return redirect(url_for('index'))
     
-    total_products = Product.query.count()
-    total_orders = Order.query.count()
-    total_sales = db.session.query(db.func.sum(Order.total_price)).scalar()
-    total_users = User.query.count()
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(5).all()
-
-    return render_template('admin/dashboard.html',
-                           total_products=total_products,
-                           total_orders=total_orders,
-                           total_sales=total_sales,
-                           total_users=total_users,
-                           recent_orders=recent_orders
+    totals = metrics.counters()
+    recent_orders = (Order.query.options(joinedload(Order.user))
+                     .order_by(Order.created_at.desc(), Order.id.desc()).limit(5).all())
+
+    return render_template('dashboard.html',
+                           total_products=int(totals['total_products']),
+                           total_orders=int(totals['total_orders']),
+                           total_sales=round(totals['total_sales'], 2),
+                           total_users=int(totals['total_users']),
+                           total_reviews=int(totals['total_reviews']),
+                           open_tickets=int(totals['open_tickets']),
+                           recent_orders=recent_orders,
+                           daily_sales=metrics.sales_series('day', days=14),
+                           top_products=metrics.top_products(days=30)
                            )
 
+# Sales time series and top products, read only from the rollup tables
+@app.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    period = request.args.get('period', 'day')
+    if period not in ('day', 'week'):
+        period = 'day'
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    return jsonify(period=period, days=days,
+                   sales=metrics.sales_series(period, days),
+                   top_products=metrics.top_products(days))
+
 @app.route('/admin/add_product', methods=['GET', 'POST'])
 @login_required
 def add_product():
@@ -128,10 +220,10 @@ def add_product():
         return redirect(url_for('index'))
     
     product_form = ProductForm()
-    product_form.category.choices = [(c.id, c.name) for c in Category.query.order_by('name')]
+    product_form.category.choices = category_choices()
 
     if product_form.validate_on_submit():
-        Product = Product(
+        product = Product(
             name=product_form.name.data,
             description=product_form.description.data,
             brand=product_form.brand.data,
@@ -142,16 +234,107 @@ def add_product():
             category_id=product_form.category.data
         )
 
-        db.session.add(Product)
-        db.session.commit()
+        saved = []
+        try:
+            db.session.add(product)
+            db.session.flush()
+
+            for upload in product_form.images.data or []:
+                if not upload or not upload.filename:
+                    continue
+                filename = secrets.token_hex(8) + '_' + secure_filename(upload.filename)
+                path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+                upload.save(path)
+                saved.append(path)
+                db.session.add(ProductImage(product_id=product.id,
+                                            image_url=url_for('static', filename='images/' + filename)))
+
+            db.session.commit()
+        except Exception:
+            # Files are written before the commit; drop them if it never lands
+            db.session.rollback()
+            for path in saved:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
         flash('Your product has been created!', 'success')
         return redirect(url_for('admin_dashboard'))
     
-    return render_template('admin/add_product.html', product_form=product_form, title='New Product', legend='New Product')
+    return render_template('add_product.html', form=product_form, title='New Product', legend='New Product')
+
+# Bulk product feed: validated and upserted in chunks straight from the upload
+@app.route('/admin/catalog/import', methods=['GET', 'POST'])
+@login_required
+def import_catalog():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+
+    import_form = CatalogImportForm()
+    report = None
+    if import_form.validate_on_submit():
+        feed = import_form.feed.data
+        report = catalog_io.import_catalog(catalog_io.open_upload(feed),
+                                           catalog_io.detect_format(feed.filename)).as_dict()
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify(report)
+    return render_template('import_catalog.html', import_form=import_form, report=report)
+
+@app.route('/admin/catalog/export.<any(csv, jsonl):fmt>')
+@login_required
+def export_catalog(fmt):
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(catalog_io.export_catalog(fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=catalog.{fmt}'})
+
+# Users active in this worker process, from memory only
+@app.route('/admin/presence')
+@login_required
+def admin_presence():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+    return jsonify(active=[{'user_id': user_id, 'last_seen': last_seen}
+                           for user_id, last_seen in presence.active_users()])
+
+# Rolling per-endpoint timings, slowest statements and possible N+1s
+@app.route('/admin/instrumentation')
+@login_required
+def instrumentation_stats():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+    return jsonify(instrumentation.stats())
+
+# Open chat streams and unsaved messages in this worker process
+@app.route('/admin/chat')
+@login_required
+def chat_stats():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+    return jsonify(chat.stats())
+
+# Job counts per queue and status
+@app.route('/admin/jobs')
+@login_required
+def job_stats():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+    return jsonify(jobs.stats())
+
+@app.route('/admin/cache')
+@login_required
+def cache_stats():
+    if not current_user.is_admin:
+        return redirect(url_for('index'))
+    return jsonify(cache.stats())
 
 @app.route("/review/new/<int:product_id>", methods=['GET', 'POST'])
 @login_required
 def new_review(product_id):
+    if product_detail(product_id) is None:
+        abort(404)
     review_form = ReviewForm()
     if review_form.validate_on_submit():
         review = Review(
@@ -162,16 +345,34 @@ def new_review(product_id):
             )
         db.session.add(review)
         db.session.commit()
+        metrics.schedule_recount('total_reviews')
         flash('Your review has been posted!', 'success')
         return redirect(url_for('product', product_id=product_id))
     return render_template('create_review.html', title='New Review', review_form=review_form, legend='New Review')
 
+@app.route("/review/<int:review_id>/delete", methods=['POST'])
+@login_required
+def delete_review(review_id):
+    review = db.get_or_404(Review, review_id)
+    if review.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    product_id = review.product_id
+    db.session.delete(review)
+    db.session.commit()
+    metrics.schedule_recount('total_reviews')
+    flash('Your review has been deleted.', 'success')
+    return redirect(url_for('product', product_id=product_id))
+
 
 @app.route("/register", methods=['GET', 'POST'])
 def register():
     register_form = RegistrationForm()
     if register_form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(register_form.password.data).decode('utf-8')
+        try:
+            hashed_password = auth.passwords.hash(register_form.password.data)
+        except auth.HasherBusy:
+            flash('We are busy right now, please try again in a moment.', 'warning')
+            return render_template('register.html', title='Register', register_form=register_form), 503
         user = User(
             username=register_form.username.data, 
             email=register_form.email.data, 
@@ -183,6 +384,7 @@ def register():
             )
         db.session.add(user)
         db.session.commit()
+        mail.send(register_form.email.data, 'Welcome to the shop', 'welcome', fullname=register_form.fullname.data)
         flash('Your account has been created!', 'success')
         return redirect(url_for('login'))
     return render_template('register.html', title='Register', register_form=register_form)
@@ -220,16 +422,177 @@ def new_ticket():
             )
         db.session.add(ticket)
         db.session.commit()
+        mail.send(current_user.record.email, f'Support ticket #{ticket.id}: {ticket.subject}', 'ticket_opened',
+                  ticket_id=ticket.id, subject=ticket.subject)
+        metrics.schedule_recount('open_tickets')
         flash('Your support ticket has been submitted!', 'success')
-        return redirect(url_for('account'))
+        return redirect(url_for('support_chat', ticket_id=ticket.id))
     return render_template('create_ticket.html', title='New Support Ticket', support_ticket_form=support_ticket_form, legend='New Support Ticket')
 
+def support_ticket_or_404(ticket_id):
+    ticket = db.get_or_404(SupportTicket, ticket_id)
+    if ticket.user_id != current_user.id and not current_user.is_admin:
+        abort(404)
+    return ticket
+
+def chat_cursor(value):
+    # Message timestamps double as cursors for catching up; they are naive UTC
+    try:
+        cursor = datetime.fromisoformat(value) if value else None
+    except ValueError:
+        abort(400)
+    if cursor is not None and cursor.tzinfo is not None:
+        cursor = cursor.astimezone(timezone.utc).replace(tzinfo=None)
+    return cursor
+
+@app.route("/support/<int:ticket_id>")
+@login_required
+@read_only
+def support_chat(ticket_id):
+    ticket = support_ticket_or_404(ticket_id)
+    return render_template('chat.html', ticket=ticket, messages=chat.history(ticket.id), chat_form=ChatMessageForm())
+
+@app.route("/support/<int:ticket_id>/messages", methods=['GET', 'POST'])
+@login_required
+def support_messages(ticket_id):
+    ticket = support_ticket_or_404(ticket_id)
+    if request.method == 'GET':
+        return jsonify(messages=chat.history(ticket.id, chat_cursor(request.args.get('since'))))
+    chat_form = ChatMessageForm()
+    if not chat_form.validate_on_submit():
+        return jsonify(errors=chat_form.errors), 400
+    return jsonify(chat.post(ticket.id, current_user.id, chat_form.message.data)), 201
+
+# Server-Sent Events; the generator holds no request context or database
+# connection while it waits, so an idle stream is cheap under gevent
+@app.route("/support/<int:ticket_id>/stream")
+@login_required
+@read_only
+def support_stream(ticket_id):
+    ticket = support_ticket_or_404(ticket_id)
+    since = chat_cursor(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    return Response(chat.stream(ticket.id, since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route("/shop_collection", methods=['GET', 'POST'])
+@conditional
+@read_only
 def shop_collection():
-    products = Product.query.all()
-    return render_template("shop.html", products=products)
+    filters = parse_filters(request.args)
+    try:
+        page = cached_page(**filters)
+    except InvalidCursor:
+        return redirect(url_for('shop_collection', **{k: v for k, v in request.args.items() if k != 'cursor'}))
+
+    return render_template("shop.html", products=page['items'], next_cursor=page['next_cursor'],
+                           filters=filters, categories=category_choices())
+
+# JSON variant of the shop listing for infinite scroll
+@app.route("/api/products")
+@read_only
+def api_products():
+    try:
+        page = cached_page(**parse_filters(request.args))
+    except InvalidCursor as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(page)
+
+def search_args():
+    category_id = request.args.get('category', type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    min_rating = request.args.get('min_rating', type=float)
+    sort = 'rating' if request.args.get('sort') == 'rating' else 'relevance'
+    return request.args.get('q', '').strip(), category_id, page, min_rating, sort
+
+@app.route("/search")
+@read_only
+def search_products():
+    query, category_id, page, min_rating, sort = search_args()
+    results = cached_search(query, category_id, page, min_rating, sort)
+    return render_template("search.html", results=results, category_id=category_id)
+
+@app.route("/api/search")
+@read_only
+def api_search():
+    return jsonify(cached_search(*search_args()))
+
+@app.route("/product/<int:product_id>")
+@read_only
+def product(product_id):
+    product = product_detail(product_id)
+    if product is None:
+        abort(404)
+    return render_template("product.html", product=product, cart_form=CartForm(),
+                           recommended=recommendations.for_product(product_id))
+
+@app.route("/cart")
+@read_only
+def view_cart():
+    items, total = cart.view()
+    return render_template('cart.html', items=items, total=total, cart_form=CartForm(),
+                           recommended=recommendations.for_cart(cart.get_lines()))
+
+@app.route("/cart/add/<int:product_id>", methods=['POST'])
+def add_to_cart(product_id):
+    cart_form = CartForm()
+    if product_detail(product_id) is None:
+        abort(404)
+    if cart_form.validate_on_submit() and cart_form.quantity.data > 0:
+        if cart.add(product_id, cart_form.quantity.data):
+            flash('Added to your cart.', 'success')
+        else:
+            flash(f'Your cart can hold at most {cart.MAX_LINES} different products.', 'warning')
+    return redirect(url_for('view_cart'))
+
+@app.route("/cart/update/<int:product_id>", methods=['POST'])
+def update_cart(product_id):
+    cart_form = CartForm()
+    if cart_form.validate_on_submit():
+        cart.set_quantity(product_id, cart_form.quantity.data)
+    return redirect(url_for('view_cart'))
+
+@app.route("/checkout", methods=['GET', 'POST'])
+@login_required
+def checkout_order():
+    checkout_form = CheckoutForm()
+    addresses = Address.query.filter_by(user_id=current_user.id).all()
+    checkout_form.shipping_address_id.choices = [(a.id, f'{a.street}, {a.city}') for a in addresses]
+
+    if checkout_form.validate_on_submit():
+        address_id = checkout_form.shipping_address_id.data
+        if address_id not in {a.id for a in addresses}:
+            address_id = None
+        lines = cart.get_lines()
+        try:
+            order_id = checkout.checkout_cart(current_user.id, list(lines.items()),
+                                              checkout_form.idempotency_key.data, address_id, address_id)
+        except checkout.CheckoutError as e:
+            flash(str(e), 'warning')
+            return redirect(url_for('checkout_order'))
+        cart.clear()
+        mail.send(current_user.record.email, f'Order #{order_id} confirmed', 'order_placed', order_id=order_id)
+        inventory.schedule_scan(lines)
+        recommendations.schedule_update()
+        flash('Your order has been placed!', 'success')
+        return redirect(url_for('order_detail', order_id=order_id))
+
+    # A fresh key per rendered form; resubmitting the same form replays its order
+    checkout_form.idempotency_key.data = secrets.token_urlsafe(24)
+    items, total = cart.view()
+    return render_template('checkout.html', items=items, total=total, checkout_form=checkout_form, addresses=addresses)
+
+@app.route("/orders/<int:order_id>")
+@login_required
+def order_detail(order_id):
+    order = db.get_or_404(Order, order_id)
+    if order.user_id != current_user.id and not current_user.is_admin:
+        abort(404)
+    items = (OrderItem.query.options(joinedload(OrderItem.product))
+             .filter_by(order_id=order.id).all())
+    return render_template('order.html', order=order, items=items)
 
 @app.route("/about")
+@conditional
 def about_us():
     return render_template('about.html')
 
@@ -245,6 +608,8 @@ def contact_us():
             )
         db.session.add(contact)
         db.session.commit()
+        mail.send(contact_form.email.data, 'We received your message', 'contact_received',
+                  first_name=contact_form.first_name.data)
         flash('Your message has been submitted successfully!', 'success')
         return redirect(url_for('index'))
 
@@ -0,0 +1,228 @@
+import time
+from datetime import datetime, timedelta, timezone
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from jobs import jobs
+from models import (db, Product, User, Order, OrderItem, Review, SupportTicket, StoreCounter, DailySales,
+                    ProductDailySales)
+
+COUNTERS = ('total_products', 'total_orders', 'total_sales', 'total_users', 'total_reviews', 'open_tickets')
+# Not kept by flush events: recounted by a background job after the writes
+# that change them, one recount per burst of writes
+RECOUNTED = {
+    'total_reviews': select(func.count(Review.id)),
+    'open_tickets': select(func.count(SupportTicket.id)).where(SupportTicket.status == 'Open'),
+}
+
+
+# Rollups are written with upserts on the flush's own connection, so they
+# commit or roll back together with the rows they summarise.
+def bump_counter(connection, name, amount=1):
+    stmt = insert(StoreCounter).values(name=name, value=amount)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[StoreCounter.name],
+        set_={'value': StoreCounter.value + stmt.excluded.value},
+    ))
+
+
+def record_order(connection, created_at, total_price):
+    day = (created_at or datetime.now(timezone.utc)).date()
+    bump_counter(connection, 'total_orders')
+    bump_counter(connection, 'total_sales', total_price or 0)
+    stmt = insert(DailySales).values(day=day, order_count=1, revenue=total_price or 0)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[DailySales.day],
+        set_={'order_count': DailySales.order_count + 1,
+              'revenue': DailySales.revenue + stmt.excluded.revenue},
+    ))
+
+
+def record_order_items(connection, created_at, items):
+    # items: iterable of (product_id, quantity, unit_price). Lines of the same
+    # product are summed first so each product costs one upsert.
+    day = (created_at or datetime.now(timezone.utc)).date()
+    totals = {}
+    for product_id, quantity, price in items:
+        units, revenue = totals.get(product_id, (0, 0.0))
+        totals[product_id] = (units + quantity, revenue + quantity * price)
+    if not totals:
+        return
+    stmt = insert(ProductDailySales)
+    connection.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[ProductDailySales.day, ProductDailySales.product_id],
+            set_={'units': ProductDailySales.units + stmt.excluded.units,
+                  'revenue': ProductDailySales.revenue + stmt.excluded.revenue},
+        ),
+        [{'day': day, 'product_id': product_id, 'units': units, 'revenue': revenue}
+         for product_id, (units, revenue) in totals.items()],
+    )
+
+
+@event.listens_for(Order, 'after_insert')
+def _order_inserted(mapper, connection, target):
+    record_order(connection, target.created_at, target.total_price)
+
+
+@event.listens_for(Order, 'after_update')
+def _order_updated(mapper, connection, target):
+    history = inspect(target).attrs.total_price.history
+    if not history.has_changes():
+        return
+    delta = (target.total_price or 0) - sum(history.deleted or [0])
+    day = (target.created_at or datetime.now(timezone.utc)).date()
+    bump_counter(connection, 'total_sales', delta)
+    connection.execute(
+        DailySales.__table__.update()
+        .where(DailySales.day == day)
+        .values(revenue=DailySales.revenue + delta)
+    )
+
+
+@event.listens_for(OrderItem, 'after_insert')
+def _order_item_inserted(mapper, connection, target):
+    created_at = connection.execute(select(Order.created_at).where(Order.id == target.order_id)).scalar()
+    record_order_items(connection, created_at, [(target.product_id, target.quantity, target.price)])
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    bump_counter(connection, 'total_users')
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    bump_counter(connection, 'total_users', -1)
+
+
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    bump_counter(connection, 'total_products')
+
+
+@event.listens_for(Product, 'after_delete')
+def _product_deleted(mapper, connection, target):
+    bump_counter(connection, 'total_products', -1)
+
+
+def recount(connection, names):
+    for name in names:
+        stmt = insert(StoreCounter).values(name=name, value=connection.execute(RECOUNTED[name]).scalar())
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=[StoreCounter.name],
+            set_={'value': stmt.excluded.value},
+        ))
+
+
+@jobs.task('metrics.recount')
+def _recount_job(names):
+    with db.engine.begin() as connection:
+        recount(connection, names)
+
+
+def schedule_recount(name):
+    jobs.enqueue('metrics.recount', {'names': [name]}, unique_key=f'metrics.recount:{name}')
+
+
+# Rollup days are UTC dates, like Order.created_at
+def today():
+    return datetime.now(timezone.utc).date()
+
+
+def counters():
+    values = dict(db.session.query(StoreCounter.name, StoreCounter.value))
+    if not values:
+        # First read on a database that predates the rollup tables
+        values = rebuild(db.session.connection())
+        db.session.commit()
+    for name in RECOUNTED:
+        if name not in values:
+            # Counter added after the last rebuild
+            schedule_recount(name)
+    return {name: values.get(name, 0) for name in COUNTERS}
+
+
+def sales_series(period='day', days=30):
+    since = today() - timedelta(days=days - 1)
+    if period == 'week':
+        # Weeks start on Monday
+        bucket = func.date(DailySales.day, '-6 days', 'weekday 1')
+    else:
+        bucket = DailySales.day
+    rows = (
+        db.session.query(bucket.label('bucket'),
+                         func.sum(DailySales.order_count), func.sum(DailySales.revenue))
+        .filter(DailySales.day >= since)
+        .group_by('bucket')
+        .order_by('bucket')
+        .all()
+    )
+    return [{'period': str(b), 'orders': int(orders), 'revenue': round(revenue, 2)}
+            for b, orders, revenue in rows]
+
+
+def top_products(days=30, limit=10):
+    since = today() - timedelta(days=days - 1)
+    totals = (
+        db.session.query(ProductDailySales.product_id,
+                         func.sum(ProductDailySales.units).label('units'),
+                         func.sum(ProductDailySales.revenue).label('revenue'))
+        .filter(ProductDailySales.day >= since)
+        .group_by(ProductDailySales.product_id)
+        .order_by(func.sum(ProductDailySales.revenue).desc())
+        .limit(limit)
+        .subquery()
+    )
+    rows = (
+        db.session.query(totals.c.product_id, Product.name, totals.c.units, totals.c.revenue)
+        .join(Product, Product.id == totals.c.product_id)
+        .order_by(totals.c.revenue.desc())
+        .all()
+    )
+    return [{'product_id': pid, 'name': name, 'units': int(units), 'revenue': round(revenue, 2)}
+            for pid, name, units, revenue in rows]
+
+
+def rebuild(connection):
+    # Recomputes every rollup from the source tables in one transaction
+    connection.execute(StoreCounter.__table__.delete())
+    connection.execute(DailySales.__table__.delete())
+    connection.execute(ProductDailySales.__table__.delete())
+
+    totals = {
+        'total_products': connection.execute(select(func.count(Product.id))).scalar(),
+        'total_orders': connection.execute(select(func.count(Order.id))).scalar(),
+        'total_sales': connection.execute(select(func.coalesce(func.sum(Order.total_price), 0))).scalar(),
+        'total_users': connection.execute(select(func.count(User.id))).scalar(),
+        **{name: connection.execute(query).scalar() for name, query in RECOUNTED.items()},
+    }
+    connection.execute(insert(StoreCounter), [{'name': k, 'value': v} for k, v in totals.items()])
+
+    day = func.date(Order.created_at)
+    connection.execute(insert(DailySales).from_select(
+        ['day', 'order_count', 'revenue'],
+        select(day, func.count(Order.id), func.sum(Order.total_price)).group_by(day),
+    ))
+    connection.execute(insert(ProductDailySales).from_select(
+        ['day', 'product_id', 'units', 'revenue'],
+        select(day, OrderItem.product_id, func.sum(OrderItem.quantity),
+               func.sum(OrderItem.quantity * OrderItem.price))
+        .join(Order, Order.id == OrderItem.order_id)
+        .group_by(day, OrderItem.product_id),
+    ))
+    return totals
+
+
+metrics_cli = AppGroup('metrics', help='Maintain the admin dashboard rollups.')
+
+
+@metrics_cli.command('rebuild')
+def rebuild_command():
+    """Recompute dashboard counters and daily sales rollups from scratch."""
+    started = time.perf_counter()
+    with db.engine.begin() as connection:
+        totals = rebuild(connection)
+    click.echo(', '.join(f'{k}={v}' for k, v in totals.items()))
+    click.echo(f'Rebuilt rollups in {time.perf_counter() - started:.2f}s')
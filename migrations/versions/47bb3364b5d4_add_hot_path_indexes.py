@@ -0,0 +1,51 @@
+"""add hot path indexes
+
+Revision ID: 47bb3364b5d4
+Revises: 
+Create Date: 2026-10-16 22:44:39.751817
+
+Indexes for the catalog sort orders and the foreign keys that listings,
+order history, reviews and carts filter on. db.create_all() already makes
+them for new databases, so every index is created only if missing.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '47bb3364b5d4'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('ix_product_created_at_id', 'product', ['created_at', 'id']),
+    ('ix_product_price_id', 'product', ['price', 'id']),
+    ('ix_product_category_created_at', 'product', ['category_id', 'created_at', 'id']),
+    ('ix_product_brand', 'product', ['brand']),
+    ('ix_product_image_product_id', 'product_image', ['product_id']),
+    ('ix_order_user_created_at', 'order', ['user_id', 'created_at']),
+    ('ix_order_created_at_id', 'order', ['created_at', 'id']),
+    ('ix_order_item_order_id', 'order_item', ['order_id']),
+    ('ix_order_item_product_order', 'order_item', ['product_id', 'order_id']),
+    ('ix_review_product_created_at', 'review', ['product_id', 'created_at']),
+    ('ix_cart_user_id', 'cart', ['user_id']),
+    ('ix_cart_item_cart_product', 'cart_item', ['cart_id', 'product_id']),
+)
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('user')}
+    if 'is_admin' not in columns:
+        with op.batch_alter_table('user') as batch_op:
+            batch_op.add_column(sa.Column('is_admin', sa.Boolean(), nullable=True))
+
+    for name, table, index_columns in INDEXES:
+        op.create_index(name, table, index_columns, if_not_exists=True)
+    op.execute('ANALYZE')
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
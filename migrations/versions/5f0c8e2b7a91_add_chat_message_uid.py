@@ -0,0 +1,36 @@
+"""add chat message uid
+
+Revision ID: 5f0c8e2b7a91
+Revises: b7d2e5f19c03
+Create Date: 2026-10-16 23:58:41.902377
+
+The id a chat message gets when it is posted, before its row is saved, so
+copies relayed between worker processes and the saved row are told apart
+from other messages with the same timestamp. Older rows keep a NULL uid.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0c8e2b7a91'
+down_revision = 'b7d2e5f19c03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('chat_message')}
+    if 'uid' not in columns:
+        with op.batch_alter_table('chat_message') as batch_op:
+            batch_op.add_column(sa.Column('uid', sa.String(length=32), nullable=True))
+    op.create_index('ix_chat_message_uid', 'chat_message', ['uid'], unique=True, if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_chat_message_uid', table_name='chat_message', if_exists=True)
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('chat_message')}
+    if 'uid' in columns:
+        with op.batch_alter_table('chat_message') as batch_op:
+            batch_op.drop_column('uid')
@@ -0,0 +1,37 @@
+"""add product recommendation
+
+Revision ID: 8c1f2d9a4e67
+Revises: 47bb3364b5d4
+Create Date: 2026-10-16 23:30:12.418305
+
+Top-K neighbour lists written by `flask recommendations build`. The table
+may already exist on databases made with db.create_all().
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1f2d9a4e67'
+down_revision = '47bb3364b5d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('product_recommendation'):
+        return
+    op.create_table(
+        'product_recommendation',
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('neighbours', sa.Text(), nullable=False),
+        sa.Column('built_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['product_id'], ['product.id']),
+        sa.PrimaryKeyConstraint('product_id', 'kind'),
+    )
+
+
+def downgrade():
+    op.drop_table('product_recommendation')
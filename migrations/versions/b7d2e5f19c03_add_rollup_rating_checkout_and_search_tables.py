@@ -0,0 +1,131 @@
+"""add rollup, rating, checkout and search tables
+
+Revision ID: b7d2e5f19c03
+Revises: 8c1f2d9a4e67
+Create Date: 2026-10-16 23:52:08.531274
+
+Tables that db.create_all() makes for new databases but an existing one
+never got: the dashboard rollups, per-product rating aggregates, checkout
+idempotency keys and the FTS5 product search index with its sync triggers.
+Anything already present is left alone. Rating rows are filled in from the
+reviews and the search index is built from the product table; the rollups
+are seeded by the first dashboard view.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e5f19c03'
+down_revision = '8c1f2d9a4e67'
+branch_labels = None
+depends_on = None
+
+SEARCH_SCHEMA = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        name, description, brand,
+        content='product', content_rowid='id',
+        prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts_vocab USING fts5vocab(product_fts, 'row')",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, description, brand)
+        VALUES (new.id, new.name, new.description, new.brand);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description, brand)
+        VALUES ('delete', old.id, old.name, old.description, old.brand);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF name, description, brand ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description, brand)
+        VALUES ('delete', old.id, old.name, old.description, old.brand);
+        INSERT INTO product_fts(rowid, name, description, brand)
+        VALUES (new.id, new.name, new.description, new.brand);
+    END""",
+)
+
+RATING_SEED = """
+    INSERT INTO product_rating (product_id, count, total, average, stars_1, stars_2, stars_3, stars_4, stars_5)
+    SELECT p.id, COUNT(r.id), COALESCE(SUM(r.rating), 0),
+           CASE WHEN COUNT(r.id) > 0 THEN SUM(r.rating) * 1.0 / COUNT(r.id) ELSE 0.0 END,
+           COALESCE(SUM(r.rating = 1), 0), COALESCE(SUM(r.rating = 2), 0), COALESCE(SUM(r.rating = 3), 0),
+           COALESCE(SUM(r.rating = 4), 0), COALESCE(SUM(r.rating = 5), 0)
+    FROM product p LEFT JOIN review r ON r.product_id = p.id
+    WHERE p.id NOT IN (SELECT product_id FROM product_rating)
+    GROUP BY p.id
+"""
+
+
+def upgrade():
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if 'store_counter' not in tables:
+        op.create_table(
+            'store_counter',
+            sa.Column('name', sa.String(length=50), nullable=False),
+            sa.Column('value', sa.Float(), nullable=False),
+            sa.PrimaryKeyConstraint('name'),
+        )
+    if 'daily_sales' not in tables:
+        op.create_table(
+            'daily_sales',
+            sa.Column('day', sa.Date(), nullable=False),
+            sa.Column('order_count', sa.Integer(), nullable=False),
+            sa.Column('revenue', sa.Float(), nullable=False),
+            sa.PrimaryKeyConstraint('day'),
+        )
+    if 'product_daily_sales' not in tables:
+        op.create_table(
+            'product_daily_sales',
+            sa.Column('day', sa.Date(), nullable=False),
+            sa.Column('product_id', sa.Integer(), nullable=False),
+            sa.Column('units', sa.Integer(), nullable=False),
+            sa.Column('revenue', sa.Float(), nullable=False),
+            sa.ForeignKeyConstraint(['product_id'], ['product.id']),
+            sa.PrimaryKeyConstraint('day', 'product_id'),
+        )
+    if 'product_rating' not in tables:
+        op.create_table(
+            'product_rating',
+            sa.Column('product_id', sa.Integer(), nullable=False),
+            sa.Column('count', sa.Integer(), nullable=False),
+            sa.Column('total', sa.Integer(), nullable=False),
+            sa.Column('average', sa.Float(), nullable=False),
+            *(sa.Column(f'stars_{n}', sa.Integer(), nullable=False) for n in range(1, 6)),
+            sa.ForeignKeyConstraint(['product_id'], ['product.id']),
+            sa.PrimaryKeyConstraint('product_id'),
+        )
+    op.create_index('ix_product_rating_average', 'product_rating', ['average', 'product_id'],
+                    if_not_exists=True)
+    op.execute(RATING_SEED)
+    if 'checkout_request' not in tables:
+        op.create_table(
+            'checkout_request',
+            sa.Column('idempotency_key', sa.String(length=64), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('order_id', sa.Integer(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['order_id'], ['order.id']),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+            sa.PrimaryKeyConstraint('idempotency_key'),
+        )
+
+    for statement in SEARCH_SCHEMA:
+        op.execute(statement)
+    if 'product_fts' not in tables:
+        op.execute("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    for trigger in ('product_fts_au', 'product_fts_ad', 'product_fts_ai'):
+        op.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    op.execute('DROP TABLE IF EXISTS product_fts_vocab')
+    op.execute('DROP TABLE IF EXISTS product_fts')
+
+    tables = set(sa.inspect(op.get_bind()).get_table_names())
+    if 'product_rating' in tables:
+        op.drop_index('ix_product_rating_average', table_name='product_rating', if_exists=True)
+    for table in ('checkout_request', 'product_rating', 'product_daily_sales', 'daily_sales', 'store_counter'):
+        if table in tables:
+            op.drop_table(table)
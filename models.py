@@ -1,8 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime, timezone
+from database import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -14,6 +15,7 @@ class User(UserMixin, db.Model):
     date_of_birth = db.Column(db.Date)
     gender = db.Column(db.String(10))
     active = db.Column(db.Boolean, default=False)
+    is_admin = db.Column(db.Boolean, default=False)
     status = db.Column(db.String, default='inactive')
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
     
@@ -58,15 +60,24 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     discount_price = db.Column(db.Float)
     stock = db.Column(db.Integer, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     
     images = db.relationship('ProductImage', backref='product', lazy=True)
     reviews = db.relationship('Review', backref='product', lazy=True)
     order_items = db.relationship('OrderItem', backref='product', lazy=True)
+    rating = db.relationship('ProductRating', backref='product', uselist=False, lazy=True)
+
+    # Keyset pagination indexes for the catalog sort orders and filters
+    __table_args__ = (
+        db.Index('ix_product_created_at_id', 'created_at', 'id'),
+        db.Index('ix_product_price_id', 'price', 'id'),
+        db.Index('ix_product_category_created_at', 'category_id', 'created_at', 'id'),
+        db.Index('ix_product_brand', 'brand'),
+    )
 
 class ProductImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     image_url = db.Column(db.String(200), nullable=False)
 
 class Category(db.Model):
@@ -79,11 +90,17 @@ class Order(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     total_price = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(50), default='Pending')
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     
     order_items = db.relationship('OrderItem', backref='order', lazy=True)
     shipping_address_id = db.Column(db.Integer, db.ForeignKey('address.id'))
     billing_address_id = db.Column(db.Integer, db.ForeignKey('address.id'))
+
+    # A user's order history, and the dashboard's most recent orders
+    __table_args__ = (
+        db.Index('ix_order_user_created_at', 'user_id', 'created_at'),
+        db.Index('ix_order_created_at_id', 'created_at', 'id'),
+    )
     
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -92,6 +109,19 @@ class OrderItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_order_item_order_id', 'order_id'),
+        db.Index('ix_order_item_product_order', 'product_id', 'order_id'),
+    )
+
+# One row per checkout attempt key, so a retried checkout returns the order
+# it already created instead of placing a second one
+class CheckoutRequest(db.Model):
+    idempotency_key = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -100,9 +130,33 @@ class Review(db.Model):
     review_text = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
 
+    __table_args__ = (
+        db.Index('ix_review_product_created_at', 'product_id', 'created_at'),
+    )
+
+# Review totals per product, kept in step with Review writes
+class ProductRating(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    average = db.Column(db.Float, nullable=False, default=0)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_product_rating_average', 'average', 'product_id'),
+    )
+
+    @property
+    def histogram(self):
+        return [self.stars_1, self.stars_2, self.stars_3, self.stars_4, self.stars_5]
+
 class Cart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     items = db.relationship('CartItem', backref='cart', lazy=True)
 
 class CartItem(db.Model):
@@ -111,6 +165,10 @@ class CartItem(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_cart_item_cart_product', 'cart_id', 'product_id'),
+    )
+
 class Payment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
@@ -137,6 +195,11 @@ class ChatMessage(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     message = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+    uid = db.Column(db.String(32))  # Assigned when posted, before the row is saved
+
+    __table_args__ = (
+        db.Index('ix_chat_message_uid', 'uid', unique=True),
+    )
     
 class InventoryRecord(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -153,3 +216,29 @@ class Contact(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     message = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+
+# Running totals for the admin dashboard, keyed by metric name
+class StoreCounter(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Float, nullable=False, default=0)
+
+# Orders and revenue per calendar day
+class DailySales(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+# Units and revenue per product per calendar day
+class ProductDailySales(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+# Top-K related products per product and kind ('bought_together', 'similar'),
+# best first, written by the recommendations builder
+class ProductRecommendation(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    kind = db.Column(db.String(20), primary_key=True)
+    neighbours = db.Column(db.Text, nullable=False)  # Comma-separated product ids
+    built_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,111 @@
+import atexit
+import threading
+import time
+from sqlalchemy import bindparam
+from models import db, User
+
+
+# Keeps each user's presence status and last-seen time in memory and writes
+# status changes to the user table in one batched UPDATE every few seconds,
+# so logins and logouts never wait on the SQLite write lock. State is per
+# process: each worker reports the users whose requests it served.
+class PresenceTracker:
+    def __init__(self):
+        self.flush_interval = 5
+        self.idle_timeout = 900
+        self._seen = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._engine = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        app.config.setdefault('PRESENCE_FLUSH_INTERVAL', 5)
+        app.config.setdefault('PRESENCE_IDLE_TIMEOUT', 900)
+        self.flush_interval = app.config['PRESENCE_FLUSH_INTERVAL']
+        self.idle_timeout = app.config['PRESENCE_IDLE_TIMEOUT']
+        self._app = app
+
+    def set_status(self, user_id, status):
+        now = time.time()
+        with self._lock:
+            self._seen[user_id] = (status, now)
+            self._dirty[user_id] = status
+        self._ensure_flusher()
+
+    def touch(self, user_id):
+        with self._lock:
+            status, _ = self._seen.get(user_id, ('active', None))
+            self._seen[user_id] = (status, time.time())
+
+    def status(self, user_id):
+        status, last_seen = self._seen.get(user_id, (None, None))
+        if status == 'active' and last_seen < time.time() - self.idle_timeout:
+            return 'idle'
+        return status
+
+    def active_users(self):
+        # [(user_id, last_seen)] of users seen recently, most recent first
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            active = [(user_id, last_seen) for user_id, (status, last_seen) in self._seen.items()
+                      if status == 'active' and last_seen >= cutoff]
+        return sorted(active, key=lambda entry: entry[1], reverse=True)
+
+    def flush(self):
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+        if pending:
+            try:
+                with self._engine.begin() as connection:
+                    connection.execute(
+                        User.__table__.update()
+                        .where(User.id == bindparam('user_id'))
+                        .values(status=bindparam('new_status')),
+                        [{'user_id': user_id, 'new_status': status} for user_id, status in pending.items()],
+                    )
+            except Exception:
+                # Put the batch back unless newer statuses arrived meanwhile
+                with self._lock:
+                    for user_id, status in pending.items():
+                        self._dirty.setdefault(user_id, status)
+                raise
+        self._prune()
+        return len(pending)
+
+    def _prune(self):
+        # Users not seen for idle_timeout are forgotten once their status is
+        # saved; their next request starts a fresh entry
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            for user_id in [user_id for user_id, (_, last_seen) in self._seen.items()
+                            if last_seen < cutoff and user_id not in self._dirty]:
+                del self._seen[user_id]
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            with self._app.app_context():
+                self._engine = db.engine
+            self._thread = threading.Thread(target=self._run, name='presence-flusher', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self._app.logger.exception('Flushing user presence failed')
+
+    def stop(self):
+        self._stop.set()
+        if self._engine is not None:
+            self.flush()
+
+
+presence = PresenceTracker()
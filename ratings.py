@@ -0,0 +1,90 @@
+import time
+import click
+from flask.cli import AppGroup
+from sqlalchemy import case, event, func, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from models import db, Product, ProductRating, Review
+
+STAR_COLUMNS = ('stars_1', 'stars_2', 'stars_3', 'stars_4', 'stars_5')
+
+
+# Adds (sign=1) or removes (sign=-1) one review of `rating` stars from a
+# product's totals with a single upsert on the flush's connection.
+def apply_review(connection, product_id, rating, sign=1):
+    star = f'stars_{rating}'
+    table = ProductRating.__table__
+    stmt = insert(ProductRating).values(product_id=product_id, count=sign, total=sign * rating,
+                                        average=float(rating) if sign > 0 else 0, **{star: sign})
+    new_count = table.c.count + sign
+    new_total = table.c.total + sign * rating
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[ProductRating.product_id],
+        set_={
+            'count': new_count,
+            'total': new_total,
+            star: table.c[star] + sign,
+            'average': case((new_count > 0, new_total * 1.0 / new_count), else_=0.0),
+        },
+    ))
+
+
+@event.listens_for(Review, 'after_insert')
+def _review_inserted(mapper, connection, target):
+    apply_review(connection, target.product_id, target.rating)
+
+
+@event.listens_for(Review, 'after_update')
+def _review_updated(mapper, connection, target):
+    attrs = inspect(target).attrs
+    rating, product = attrs.rating.history, attrs.product_id.history
+    if not rating.has_changes() and not product.has_changes():
+        return
+    old_rating = rating.deleted[0] if rating.deleted else target.rating
+    old_product = product.deleted[0] if product.deleted else target.product_id
+    apply_review(connection, old_product, old_rating, -1)
+    apply_review(connection, target.product_id, target.rating)
+
+
+@event.listens_for(Review, 'after_delete')
+def _review_deleted(mapper, connection, target):
+    apply_review(connection, target.product_id, target.rating, -1)
+
+
+# Every product gets an empty row up front, so rating sorts can inner join
+# and walk ix_product_rating_average instead of sorting an outer join.
+@event.listens_for(Product, 'after_insert')
+def _product_inserted(mapper, connection, target):
+    connection.execute(insert(ProductRating).values(product_id=target.id).on_conflict_do_nothing())
+
+
+@event.listens_for(Product, 'before_delete')
+def _product_deleted(mapper, connection, target):
+    connection.execute(ProductRating.__table__.delete().where(ProductRating.product_id == target.id))
+
+
+def rebuild(connection):
+    connection.execute(ProductRating.__table__.delete())
+    count = func.count(Review.id)
+    total = func.coalesce(func.sum(Review.rating), 0)
+    stars = [func.coalesce(func.sum(case((Review.rating == n, 1), else_=0)), 0) for n in range(1, 6)]
+    connection.execute(insert(ProductRating).from_select(
+        ['product_id', 'count', 'total', 'average', *STAR_COLUMNS],
+        select(Product.id, count, total,
+               case((count > 0, total * 1.0 / count), else_=0.0), *stars)
+        .select_from(Product)
+        .outerjoin(Review, Review.product_id == Product.id)
+        .group_by(Product.id),
+    ))
+    return connection.execute(select(func.count()).select_from(ProductRating)).scalar()
+
+
+reviews_cli = AppGroup('reviews', help='Maintain per-product review aggregates.')
+
+
+@reviews_cli.command('rebuild')
+def rebuild_command():
+    """Recompute every product's rating count, average and histogram."""
+    started = time.perf_counter()
+    with db.engine.begin() as connection:
+        count = rebuild(connection)
+    click.echo(f'Rebuilt ratings for {count} products in {time.perf_counter() - started:.2f}s')
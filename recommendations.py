@@ -0,0 +1,387 @@
+import fcntl
+import math
+import os
+import re
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+from scipy import sparse
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import joinedload, contains_eager
+from cache import cache
+from catalog import first_image_url, serialize_product
+from jobs import jobs
+from models import db, Product, Order, OrderItem, ProductRecommendation
+
+KINDS = ('bought_together', 'similar')
+TOKEN = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset(('a', 'an', 'and', 'for', 'in', 'of', 'on', 'the', 'to', 'with'))
+# Weight of a token by the field it came from; brand and category are one token each
+NAME_WEIGHT, DESCRIPTION_WEIGHT, BRAND_WEIGHT, CATEGORY_WEIGHT = 3, 1, 2, 2
+
+
+class BuildInProgress(Exception):
+    pass
+
+
+def init_app(app):
+    app.config.setdefault('RECOMMENDATIONS_PATH', os.path.join(app.instance_path, 'cooccurrence.npz'))
+    app.config.setdefault('RECOMMENDATIONS_TOP_K', 12)
+    app.config.setdefault('RECOMMENDATIONS_MIN_COUNT', 1)
+    app.config.setdefault('RECOMMENDATIONS_MAX_BASKET', 50)
+    app.config.setdefault('RECOMMENDATIONS_MAX_DF', 0.5)
+    app.config.setdefault('RECOMMENDATIONS_SETTLE', 60)
+    app.config.setdefault('RECOMMENDATIONS_UPDATE_DELAY', 300)
+    app.cli.add_command(recommendations_cli)
+
+
+# Co-occurrence state: a symmetric product x product CSR matrix of how many
+# orders contained both products (the diagonal holds each product's order
+# count), saved together with the (created_at, id) of the last order counted
+# in one .npz file, so the watermark can never disagree with the counts.
+def load_state(path):
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            watermark = (datetime.fromisoformat(str(f['watermark_at'])), int(f['watermark_id']))
+    except FileNotFoundError:
+        return None, None
+    return matrix, watermark
+
+
+def save_state(path, matrix, watermark):
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.array(matrix.shape),
+             watermark_at=np.array(watermark[0].isoformat()), watermark_id=np.array(watermark[1]))
+    os.replace(tmp, path)
+
+
+def order_baskets(connection, watermark, cutoff, chunk_size):
+    # Yields (created_at, order_id, product_ids) for orders after the
+    # watermark, oldest first, streamed chunk_size rows at a time
+    query = (select(Order.created_at, Order.id, OrderItem.product_id)
+             .join(OrderItem, OrderItem.order_id == Order.id)
+             .where(Order.created_at <= cutoff))
+    if watermark is not None:
+        query = query.where(tuple_(Order.created_at, Order.id) > tuple_(*watermark))
+    rows = connection.execution_options(yield_per=chunk_size).execute(
+        query.order_by(Order.created_at, Order.id))
+    for (created_at, order_id), group in groupby(rows, key=lambda row: (row[0], row[1])):
+        yield created_at, order_id, [row[2] for row in group]
+
+
+def count_baskets(baskets, size, max_basket, flush_every=2000000):
+    # Sums every basket's product pairs into a sparse matrix, a few million
+    # pairs at a time. Baskets bigger than max_basket (bulk buys) say little
+    # about what goes together and would add max_basket**2 pairs each.
+    total = sparse.csr_matrix((size, size), dtype=np.int32)
+    rows, cols, pending = [], [], 0
+    watermark, orders = None, 0
+    for created_at, order_id, product_ids in baskets:
+        watermark = (created_at, order_id)
+        ids = np.unique(np.fromiter(product_ids, dtype=np.int32))
+        ids = ids[ids < size]
+        if ids.size > max_basket:
+            continue
+        orders += 1
+        i, j = np.meshgrid(ids, ids)
+        rows.append(i.ravel())
+        cols.append(j.ravel())
+        pending += ids.size ** 2
+        if pending >= flush_every:
+            total += _pairs(rows, cols, size)
+            rows, cols, pending = [], [], 0
+    if rows:
+        total += _pairs(rows, cols, size)
+    return total, watermark, orders
+
+
+def _pairs(rows, cols, size):
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    # Duplicate coordinates are summed on conversion
+    return sparse.coo_matrix((np.ones(rows.size, dtype=np.int32), (rows, cols)), shape=(size, size)).tocsr()
+
+
+def _top(ids, scores, k):
+    # Best k by score, ties broken by the lower id so rebuilds are stable
+    if ids.size > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[keep], scores[keep]
+    return ids[np.lexsort((ids, -scores))]
+
+
+def bought_together(matrix, rows, exists, k, min_count):
+    # Yields (product_id, neighbour_ids) scored by cosine similarity of the
+    # products' order sets: pairs / sqrt(orders of one * orders of the other)
+    orders = matrix.diagonal().astype(np.float64)
+    for i in rows:
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        ids, counts = matrix.indices[start:end], matrix.data[start:end]
+        keep = (ids != i) & (counts >= min_count) & exists[ids]
+        ids, counts = ids[keep], counts[keep]
+        if ids.size:
+            yield int(i), _top(ids, counts / np.sqrt(orders[i] * orders[ids]), k)
+
+
+def _tokens(name, description, brand, category_id):
+    weights = {}
+    for text, weight in ((name, NAME_WEIGHT), (description, DESCRIPTION_WEIGHT)):
+        for token in TOKEN.findall((text or '').lower()):
+            if token not in STOPWORDS and len(token) > 1:
+                weights[token] = weights.get(token, 0) + weight
+    if brand:
+        weights['brand:' + brand.lower()] = BRAND_WEIGHT
+    weights[f'category:{category_id}'] = CATEGORY_WEIGHT
+    return weights
+
+
+def content_matrix(connection, size, max_df, chunk_size):
+    # L2-normalised TF-IDF rows over each product's name, description, brand
+    # and category; the dot product of two rows is their content similarity.
+    # Entries are collected in typed arrays, not lists, to stay compact.
+    vocabulary = {}
+    rows, cols, values = array('i'), array('i'), array('f')
+    documents = 0
+    result = connection.execution_options(yield_per=chunk_size).execute(
+        select(Product.id, Product.name, Product.description, Product.brand, Product.category_id))
+    for product_id, name, description, brand, category_id in result:
+        if product_id >= size:
+            # Created after the build started
+            continue
+        documents += 1
+        for token, weight in _tokens(name, description, brand, category_id).items():
+            rows.append(product_id)
+            cols.append(vocabulary.setdefault(token, len(vocabulary)))
+            values.append(1 + math.log(weight))
+    matrix = sparse.csr_matrix((np.array(values, dtype=np.float32),
+                                (np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32))),
+                               shape=(size, max(len(vocabulary), 1)))
+
+    frequency = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    idf = (np.log((1 + documents) / (1 + frequency)) + 1).astype(np.float32)
+    if documents >= 100:
+        # Words on most products ("shirt" in a shirt shop) only add noise
+        idf[frequency > max_df * documents] = 0
+    matrix.data *= idf[matrix.indices]
+    matrix.eliminate_zeros()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms, format='csr') @ matrix
+
+
+def similar(matrix, rows, exists, k, block=1000):
+    # Compares a block of products against the whole catalog at a time, so
+    # only block x catalog similarities are ever held in memory. A product
+    # with no match still gets its (empty) list, so it counts as covered.
+    transposed = matrix.T.tocsr()
+    rows = np.asarray(rows, dtype=np.int64)
+    for offset in range(0, rows.size, block):
+        chunk = rows[offset:offset + block]
+        scores = (matrix[chunk] @ transposed).tocsr()
+        for n, i in enumerate(chunk):
+            start, end = scores.indptr[n], scores.indptr[n + 1]
+            ids, values = scores.indices[start:end], scores.data[start:end]
+            keep = (ids != i) & (values > 0) & exists[ids]
+            yield int(i), _top(ids[keep], values[keep], k)
+
+
+def write_neighbours(kind, neighbours, built_at, chunk_size=5000):
+    stmt = insert(ProductRecommendation)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ProductRecommendation.product_id, ProductRecommendation.kind],
+        set_={'neighbours': stmt.excluded.neighbours, 'built_at': stmt.excluded.built_at},
+    )
+    written = 0
+    batch = []
+    for product_id, ids in neighbours:
+        batch.append({'product_id': product_id, 'kind': kind, 'built_at': built_at,
+                      'neighbours': ','.join(map(str, ids.tolist()))})
+        if len(batch) >= chunk_size:
+            with db.engine.begin() as connection:
+                connection.execute(stmt, batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        with db.engine.begin() as connection:
+            connection.execute(stmt, batch)
+        written += len(batch)
+    return written
+
+
+def build(full=False, chunk_size=5000, echo=None):
+    # A full build recounts every order and recomputes every product's
+    # neighbours. An incremental one adds only the orders placed since the
+    # saved watermark. It recomputes the bought-together lists of the products
+    # those orders touched and of everything bought with them, since a score
+    # depends on both products' order counts, and the content neighbours of
+    # products that have none yet. Orders younger than
+    # RECOMMENDATIONS_SETTLE seconds wait for the next run, so a checkout
+    # still committing cannot end up behind the watermark.
+    config = current_app.config
+    echo = echo or (lambda message: None)
+    path = config['RECOMMENDATIONS_PATH']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    started = time.perf_counter()
+    built_at = datetime.now(timezone.utc)
+
+    with open(path + '.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise BuildInProgress('Another recommendations build is running.')
+
+        matrix, watermark = (None, None) if full else load_state(path)
+        full = matrix is None
+        with db.engine.connect() as connection:
+            size = (connection.execute(select(func.max(Product.id))).scalar() or 0) + 1
+            if matrix is not None:
+                size = max(size, matrix.shape[0])
+            exists = np.zeros(size, dtype=bool)
+            exists[connection.execute(select(Product.id)).scalars().all()] = True
+            cutoff = built_at - timedelta(seconds=config['RECOMMENDATIONS_SETTLE'])
+            delta, last, orders = count_baskets(order_baskets(connection, watermark, cutoff, chunk_size),
+                                                size, config['RECOMMENDATIONS_MAX_BASKET'])
+            if full:
+                matrix = delta
+            else:
+                matrix.resize((size, size))
+                matrix = matrix + delta
+            if full:
+                content_rows = np.flatnonzero(exists)
+            else:
+                have = connection.execute(select(ProductRecommendation.product_id)
+                                          .where(ProductRecommendation.kind == 'similar')).scalars().all()
+                missing = exists.copy()
+                missing[have] = False
+                content_rows = np.flatnonzero(missing)
+            content = content_matrix(connection, size, config['RECOMMENDATIONS_MAX_DF'], chunk_size) \
+                if content_rows.size else None
+        echo(f'Counted {orders} orders into {matrix.nnz} product pairs')
+
+        # The counts are saved before the neighbour rows: if the rows fail to
+        # write, the worst case is stale neighbours, never double counting
+        if last is not None or full:
+            save_state(path, matrix, last or watermark or (datetime.min, 0))
+
+        k = config['RECOMMENDATIONS_TOP_K']
+        if full:
+            changed = np.flatnonzero(exists)
+        else:
+            touched = np.flatnonzero(np.diff(delta.indptr) > 0)
+            affected = np.zeros(size, dtype=bool)
+            affected[touched] = True
+            # The matrix is symmetric, so the touched rows list their partners
+            affected[matrix[touched].indices] = True
+            changed = np.flatnonzero(affected & exists)
+        together = write_neighbours('bought_together',
+                                    bought_together(matrix, changed, exists, k, config['RECOMMENDATIONS_MIN_COUNT']),
+                                    built_at, chunk_size)
+        alike = write_neighbours('similar', similar(content, content_rows, exists, k), built_at, chunk_size) \
+            if content is not None else 0
+        if full:
+            with db.engine.begin() as connection:
+                connection.execute(ProductRecommendation.__table__.delete()
+                                   .where(ProductRecommendation.built_at < built_at))
+
+    echo(f'Wrote {together} bought-together and {alike} similar lists in {time.perf_counter() - started:.1f}s')
+    return {'orders': orders, 'bought_together': together, 'similar': alike}
+
+
+@jobs.task('recommendations.update', max_attempts=3)
+def _update_job():
+    try:
+        build()
+    except BuildInProgress:
+        # The running build will pick these orders up next time
+        pass
+
+
+def schedule_update():
+    # Orders placed within RECOMMENDATIONS_UPDATE_DELAY share one update
+    jobs.enqueue('recommendations.update', delay=current_app.config['RECOMMENDATIONS_UPDATE_DELAY'],
+                 unique_key='recommendations.update')
+
+
+# Read path: one primary key lookup for the neighbour ids and one query for
+# the in-stock products among them. Results are cached like other catalog
+# reads; a rebuild shows up once the entries expire.
+def _neighbours(product_ids, kind):
+    rows = db.session.execute(
+        select(ProductRecommendation.product_id, ProductRecommendation.neighbours)
+        .where(ProductRecommendation.product_id.in_(product_ids), ProductRecommendation.kind == kind)).all()
+    return {product_id: [int(i) for i in neighbours.split(',') if i] for product_id, neighbours in rows}
+
+
+def _cards(product_ids):
+    if not product_ids:
+        return []
+    rows = (db.session.query(Product, first_image_url)
+            .outerjoin(Product.rating)
+            .options(joinedload(Product.category), contains_eager(Product.rating))
+            .filter(Product.id.in_(product_ids), Product.stock > 0)
+            .all())
+    cards = {product.id: serialize_product(product, image_url) for product, image_url in rows}
+    return [cards[i] for i in product_ids if i in cards]
+
+
+def for_product(product_id, limit=4):
+    def load():
+        return {kind: _cards(_neighbours([product_id], kind).get(product_id, [])[:limit * 2])[:limit]
+                for kind in KINDS}
+    return cache.get_or_set(f'recommendations:{product_id}', load)
+
+
+def for_cart(product_ids, limit=4):
+    # Products bought with the most cart lines first, ranked by their best
+    # position across those lines; similar items fill in when none were
+    product_ids = sorted(product_ids)
+    if not product_ids:
+        return []
+
+    def load():
+        in_cart = set(product_ids)
+        for kind in KINDS:
+            ranks = {}
+            for neighbours in _neighbours(product_ids, kind).values():
+                for rank, i in enumerate(neighbours):
+                    if i not in in_cart:
+                        hits, best = ranks.get(i, (0, rank))
+                        ranks[i] = (hits + 1, min(best, rank))
+            if ranks:
+                ordered = sorted(ranks, key=lambda i: (-ranks[i][0], ranks[i][1], i))
+                return _cards(ordered[:limit * 2])[:limit]
+        return []
+    return cache.get_or_set('recommendations:cart:' + ','.join(map(str, product_ids)), load)
+
+
+recommendations_cli = AppGroup('recommendations', help='Build product recommendations.')
+
+
+@recommendations_cli.command('build')
+@click.option('--full', is_flag=True, help='Recount every order instead of those since the last build.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows streamed and written per batch.')
+def build_command(full, chunk_size):
+    """Update "frequently bought together" lists from new orders and
+    "similar items" lists for new products; --full rebuilds both."""
+    try:
+        build(full, chunk_size, echo=click.echo)
+    except BuildInProgress as e:
+        raise click.ClickException(str(e))
+
+
+@recommendations_cli.command('show')
+@click.argument('product_id', type=int)
+def show_command(product_id):
+    """Print a product's stored neighbours."""
+    for kind in KINDS:
+        neighbours = _neighbours([product_id], kind).get(product_id, [])
+        names = dict(db.session.execute(select(Product.id, Product.name).where(Product.id.in_(neighbours))).all())
+        click.echo(f'{kind}:')
+        for i in neighbours:
+            click.echo(f'  {i} {names.get(i, "(deleted)")}')
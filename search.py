@@ -0,0 +1,166 @@
+import difflib
+import re
+import time
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, text
+from cache import cache
+from models import db
+
+MAX_TERMS = 8
+PAGE_SIZE = 24
+
+# Column weights for bm25(), in the order the FTS columns are declared:
+# name, description, brand. A name or brand match outranks a description match.
+DEFAULT_WEIGHTS = (10.0, 1.0, 4.0)
+
+# External-content FTS5 index over the product table, kept in sync by triggers
+# so ORM writes and bulk Core statements are both covered. The update trigger
+# only fires for the indexed columns, so stock and price changes cost nothing.
+SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        name, description, brand,
+        content='product', content_rowid='id',
+        prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts_vocab USING fts5vocab(product_fts, 'row')",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, description, brand)
+        VALUES (new.id, new.name, new.description, new.brand);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description, brand)
+        VALUES ('delete', old.id, old.name, old.description, old.brand);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF name, description, brand ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description, brand)
+        VALUES ('delete', old.id, old.name, old.description, old.brand);
+        INSERT INTO product_fts(rowid, name, description, brand)
+        VALUES (new.id, new.name, new.description, new.brand);
+    END""",
+]
+
+
+def create_search_index(connection):
+    for statement in SCHEMA:
+        connection.exec_driver_sql(statement)
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_search_index(target, connection, **kw):
+    create_search_index(connection)
+
+
+def rebuild_search_index(connection):
+    create_search_index(connection)
+    connection.exec_driver_sql("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+    connection.exec_driver_sql("INSERT INTO product_fts(product_fts) VALUES ('optimize')")
+
+
+def _next_prefix(term):
+    return term[:-1] + chr(ord(term[-1]) + 1)
+
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _match_term(term):
+    # A term that prefixes something in the index is used as a prefix query.
+    # Otherwise it is probably a typo: look for close spellings among indexed
+    # terms sharing its first letter and OR them together.
+    known = db.session.execute(
+        text('SELECT 1 FROM product_fts_vocab WHERE term >= :term AND term < :end LIMIT 1'),
+        {'term': term, 'end': _next_prefix(term)},
+    ).first()
+    if known or len(term) < 3:
+        return _quote(term) + '*'
+
+    candidates = db.session.execute(
+        text('SELECT term FROM product_fts_vocab WHERE term >= :start AND term < :end'),
+        {'start': term[0], 'end': _next_prefix(term[0])},
+    ).scalars()
+    candidates = [c for c in candidates if abs(len(c) - len(term)) <= 2]
+    matches = difflib.get_close_matches(term, candidates, n=3, cutoff=0.75)
+    if not matches:
+        return _quote(term) + '*'
+    return '(' + ' OR '.join(_quote(m) for m in matches) + ')'
+
+
+def build_match_query(query):
+    terms = re.findall(r'\w+', query.lower())[:MAX_TERMS]
+    if not terms:
+        return None
+    return ' AND '.join(_match_term(term) for term in terms)
+
+
+def search(query, category_id=None, page=1, min_rating=None, sort='relevance', weights=DEFAULT_WEIGHTS):
+    match = build_match_query(query)
+    if match is None:
+        return {'query': query, 'items': [], 'facets': [], 'total': 0, 'page': 1, 'has_more': False}
+
+    params = {'match': match, 'category_id': category_id, 'min_rating': min_rating,
+              'limit': PAGE_SIZE + 1, 'offset': (page - 1) * PAGE_SIZE}
+    bm25 = 'bm25(product_fts, {})'.format(', '.join(str(float(w)) for w in weights))
+    order_by = 'r.average DESC, score' if sort == 'rating' else 'score'
+
+    rows = db.session.execute(text(f"""
+        SELECT p.id, p.name, p.brand, p.price, p.discount_price, p.stock, p.category_id,
+               c.name AS category,
+               (SELECT image_url FROM product_image WHERE product_id = p.id ORDER BY id LIMIT 1) AS image_url,
+               CASE WHEN r.count > 0 THEN round(r.average, 2) END AS rating,
+               coalesce(r.count, 0) AS rating_count,
+               {bm25} AS score
+        FROM product_fts
+        JOIN product p ON p.id = product_fts.rowid
+        JOIN category c ON c.id = p.category_id
+        LEFT JOIN product_rating r ON r.product_id = p.id
+        WHERE product_fts MATCH :match
+          AND (:category_id IS NULL OR p.category_id = :category_id)
+          AND (:min_rating IS NULL OR (r.count > 0 AND r.average >= :min_rating))
+        ORDER BY {order_by}
+        LIMIT :limit OFFSET :offset
+    """), params).mappings().all()
+
+    # Facet counts ignore the category filter so the sidebar can offer the
+    # other categories the query also matches.
+    facets = db.session.execute(text("""
+        SELECT c.id, c.name, COUNT(*) AS count
+        FROM product_fts
+        JOIN product p ON p.id = product_fts.rowid
+        JOIN category c ON c.id = p.category_id
+        LEFT JOIN product_rating r ON r.product_id = p.id
+        WHERE product_fts MATCH :match
+          AND (:min_rating IS NULL OR (r.count > 0 AND r.average >= :min_rating))
+        GROUP BY c.id, c.name
+        ORDER BY count DESC, c.name
+    """), {'match': match, 'min_rating': min_rating}).mappings().all()
+
+    items = [dict(row) for row in rows[:PAGE_SIZE]]
+    return {
+        'query': query,
+        'items': items,
+        'facets': [dict(facet) for facet in facets],
+        'total': sum(facet['count'] for facet in facets),
+        'page': page,
+        'has_more': len(rows) > PAGE_SIZE,
+    }
+
+
+def cached_search(query, category_id=None, page=1, min_rating=None, sort='relevance'):
+    key = 'search:{}:{}:{}:{}:{}'.format(' '.join(query.lower().split()), category_id, page, min_rating, sort)
+    return cache.get_or_set(key, lambda: search(query, category_id, page, min_rating, sort))
+
+
+search_cli = AppGroup('search', help='Manage the product full-text search index.')
+
+
+@search_cli.command('reindex')
+def reindex_command():
+    """Rebuild the full-text index from the product table."""
+    started = time.perf_counter()
+    with db.engine.begin() as connection:
+        rebuild_search_index(connection)
+        count = connection.exec_driver_sql('SELECT COUNT(*) FROM product').scalar()
+    cache.invalidate()
+    click.echo(f'Indexed {count} products in {time.perf_counter() - started:.2f}s')
@@ -0,0 +1,102 @@
+import random
+import threading
+import pytest
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from checkout import OutOfStock, existing_order, place_order
+from models import db, Category, CheckoutRequest, Order, OrderItem, Product, User
+
+STOCK = 20
+PRODUCTS = (1, 2, 3)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "checkout.db"}', connect_args={'timeout': 60})
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User), [
+            {'id': user_id, 'username': f'user{user_id}', 'email': f'user{user_id}@example.com', 'password': 'x'}
+            for user_id in (1, 2)
+        ])
+        connection.execute(insert(Category).values(id=1, name='test'))
+        connection.execute(insert(Product), [
+            {'id': pid, 'name': f'p{pid}', 'description': '-', 'category_id': 1,
+             'sku': f'sku-{pid}', 'price': 1.0 + pid, 'stock': STOCK}
+            for pid in PRODUCTS
+        ])
+    yield engine
+    engine.dispose()
+
+
+def checkout(engine, user_id, lines, key):
+    # What a request does: replay a known key, otherwise place the order,
+    # retrying while another writer holds the database lock
+    for _ in range(20):
+        try:
+            with engine.begin() as connection:
+                order_id = existing_order(connection, user_id, key)
+                if order_id is not None:
+                    return 'replayed', order_id
+                order_id, _ = place_order(connection, user_id, lines, key)
+                return 'placed', order_id
+        except OutOfStock:
+            return 'out_of_stock', None
+        except IntegrityError:
+            return 'replayed', None
+        except OperationalError:
+            continue
+    raise AssertionError('database stayed locked')
+
+
+def test_concurrent_checkouts_never_oversell(engine):
+    rng = random.Random(7)
+    keys = [f'key-{i}' for i in range(60)]
+    # Every key is submitted twice, by different threads, like a double click
+    attempts = [(key, [(rng.choice(PRODUCTS), rng.randint(1, 3))]) for key in keys] * 2
+    rng.shuffle(attempts)
+    results = []
+    lock = threading.Lock()
+
+    def worker(batch):
+        for key, lines in batch:
+            outcome = checkout(engine, 1, lines, key)
+            with lock:
+                results.append((key, outcome))
+
+    threads = [threading.Thread(target=worker, args=(attempts[i::8],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with engine.connect() as connection:
+        stock = dict(connection.execute(select(Product.id, Product.stock)).all())
+        sold = dict(connection.execute(
+            select(OrderItem.product_id, func.sum(OrderItem.quantity)).group_by(OrderItem.product_id)
+        ).all())
+        orders = connection.execute(select(func.count(Order.id))).scalar()
+        orders_per_key = dict(connection.execute(
+            select(CheckoutRequest.idempotency_key, CheckoutRequest.order_id)
+            .where(CheckoutRequest.order_id.isnot(None))
+        ).all())
+
+    for pid in PRODUCTS:
+        assert stock[pid] >= 0
+        assert stock[pid] + sold.get(pid, 0) == STOCK
+    placed = [key for key, (outcome, _) in results if outcome == 'placed']
+    assert len(placed) == len(set(placed)) == orders == len(orders_per_key)
+    assert len(set(orders_per_key.values())) == orders
+    for key, (outcome, order_id) in results:
+        if outcome == 'replayed' and order_id is not None:
+            assert orders_per_key[key] == order_id
+
+
+def test_existing_order_is_scoped_to_user(engine):
+    with engine.begin() as connection:
+        order_id, _ = place_order(connection, 1, [(1, 1)], 'shared-key')
+    with engine.begin() as connection:
+        assert existing_order(connection, 1, 'shared-key') == order_id
+        assert existing_order(connection, 2, 'shared-key') is None
+    with pytest.raises(IntegrityError), engine.begin() as connection:
+        place_order(connection, 2, [(1, 1)], 'shared-key')